@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+"""
+Benchmarks for stock_market.py.
+Every benchmark prints its results as one JSON object, run python benchmark.py --help
+for the list of benchmarks and their options.
+"""
+
+# run in a fresh interpreter, prints seconds spent in the import and peak RSS in kilobytes
+IMPORT_SCRIPT = """
+import resource, time
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def _run_import(statement):
+    output = subprocess.run([sys.executable, '-c', IMPORT_SCRIPT.format(statement=statement)],
+                            check=True, capture_output=True, text=True).stdout.split()
+    return float(output[0]), int(output[1])
+
+
+def bench_import(repeat=20):
+    """
+    Measure how long `import stock_market` takes in a fresh interpreter and how much it
+    adds to peak RSS, compared to an interpreter which imports nothing.
+    """
+    baseline = [_run_import('pass') for _ in range(repeat)]
+    imported = [_run_import('import stock_market') for _ in range(repeat)]
+
+    import_times = sorted(result[0] for result in imported)
+    return {
+        'benchmark': 'import',
+        'repeat': repeat,
+        'import_seconds_median': statistics.median(import_times),
+        'import_seconds_min': import_times[0],
+        'rss_kb_added_median': (statistics.median(result[1] for result in imported) -
+                                statistics.median(result[1] for result in baseline)),
+    }
+
+
+def bench_threads(max_threads=8, trades_per_thread=50000, stocks_per_thread=4):
+    """
+    Measure record_trade throughput of one Market when 1 .. max_threads threads record
+    trades at the same time, every thread on its own stocks.
+    """
+    from stock_market import Market
+
+    results = []
+    for thread_count in range(1, max_threads + 1):
+        market = Market()
+        names = [['T%d_%d' % (thread, number) for number in range(stocks_per_thread)]
+                 for thread in range(thread_count)]
+        for thread_names in names:
+            for name in thread_names:
+                market.create_stock(name, 'C', 5, 100)
+
+        def record(thread_names):
+            record_trade = market.record_trade
+            for number in range(trades_per_thread):
+                record_trade(thread_names[number % stocks_per_thread], 10, 'B', 100 + number % 7)
+
+        threads = [threading.Thread(target=record, args=(thread_names,)) for thread_names in names]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        results.append({'threads': thread_count,
+                        'trades_per_second': thread_count * trades_per_thread / elapsed})
+    return {'benchmark': 'threads', 'trades_per_thread': trades_per_thread, 'results': results}
+
+
+def bench_processes(max_processes=4, trade_count=500000, stock_count=64, batch_size=10000):
+    """
+    Measure how fast ShardedEngine with 1 .. max_processes workers records a synthetic feed,
+    including the time until all workers have recorded it.
+    """
+    from sharded_engine import ShardedEngine
+
+    names = ['S%d' % number for number in range(stock_count)]
+    feed = [(names[number % stock_count], 1 + number % 50, 'BS'[number % 2], 100 + number % 13)
+            for number in range(trade_count)]
+
+    results = []
+    for process_count in range(1, max_processes + 1):
+        with ShardedEngine(process_count, batch_size) as engine:
+            for name in names:
+                engine.create_stock(name, 'C', 5, 100)
+            start = time.perf_counter()
+            for first in range(0, trade_count, batch_size):
+                engine.record_trades(feed[first:first + batch_size])
+            engine.flush()
+            engine.gbce_all_share_index()
+            elapsed = time.perf_counter() - start
+        results.append({'processes': process_count, 'trades_per_second': trade_count / elapsed})
+    return {'benchmark': 'processes', 'trade_count': trade_count, 'stock_count': stock_count,
+            'results': results}
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def _load_connection(host, port, requests, depth, latencies):
+    """Send requests over one connection, depth of them at a time without waiting for responses."""
+    reader, writer = await asyncio.open_connection(host, port)
+    for first in range(0, len(requests), depth):
+        window = requests[first:first + depth]
+        start = time.perf_counter()
+        writer.write(b''.join(window))
+        for _ in window:
+            await reader.readline()
+            latencies.append(time.perf_counter() - start)
+    writer.close()
+    await writer.wait_closed()
+
+
+async def _load(host, port, connections, requests_per_connection, depth, stock_count):
+    names = [b'S%d' % number for number in range(stock_count)]
+    setup = [b'C %s C 5 100\n' % name for name in names]
+    await _load_connection(host, port, setup, len(setup), [])
+
+    # mostly trades, with every kind of query mixed in
+    mix = []
+    for number in range(requests_per_connection):
+        name = names[number % stock_count]
+        kind = number % 10
+        if kind < 6:
+            mix.append(b'T %s %d %s %d\n' % (name, 1 + number % 50, b'BS'[number % 2:number % 2 + 1], 100 + number % 13))
+        elif kind < 8:
+            mix.append(b'VWSP %s\n' % name)
+        elif kind == 8:
+            mix.append(b'DY %s 100\n' % name)
+        else:
+            mix.append(b'GBCE\n')
+
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[_load_connection(host, port, mix, depth, latencies) for _ in range(connections)])
+    return latencies, time.perf_counter() - start
+
+
+def bench_server(connections=16, requests_per_connection=5000, depth=16, stock_count=64):
+    """
+    Start server.py in its own process and measure latency percentiles and requests per
+    second seen by concurrent pipelining clients.
+    """
+    server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py'),
+                               '--port', '0'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        # server prints only the address it listens on
+        host, port = server.stdout.readline().split()[-2:]
+        latencies, elapsed = asyncio.run(_load(host, int(port), connections, requests_per_connection,
+                                               depth, stock_count))
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies.sort()
+    return {'benchmark': 'server', 'connections': connections, 'depth': depth,
+            'requests': len(latencies), 'requests_per_second': len(latencies) / elapsed,
+            'latency_seconds_p50': _percentile(latencies, 0.5),
+            'latency_seconds_p99': _percentile(latencies, 0.99)}
+
+
+def order_flow(order_count, stock_count, seed=0):
+    """
+    Return names of stock_count stocks and order_count synthetic orders as (kind, *arguments)
+    tuples: mostly limit orders a few ticks around 100, some of them crossing the book,
+    cancels of earlier limit orders and market orders.
+    """
+    generator = random.Random(seed)
+    names = ['S%d' % number for number in range(stock_count)]
+    orders = []
+    # limit orders get ids 1, 2, ... in the order they are sent
+    limit_count = 0
+    for _ in range(order_count):
+        kind = generator.random()
+        side = 'BS'[generator.getrandbits(1)]
+        if kind < 0.65 or limit_count == 0:
+            # one order of ten crosses the best price on the other side
+            ticks = generator.randint(1, 20) if generator.random() < 0.9 else -generator.randint(1, 3)
+            price = 100 - ticks * 0.05 if side == 'B' else 100 + ticks * 0.05
+            orders.append(('limit', generator.choice(names), side, generator.randint(1, 500), round(price, 2)))
+            limit_count += 1
+        elif kind < 0.95:
+            orders.append(('cancel', generator.randint(max(1, limit_count - 1000), limit_count)))
+        else:
+            orders.append(('market', generator.choice(names), side, generator.randint(1, 500)))
+    return names, orders
+
+
+def bench_order_book(order_count=1000000, stock_count=10, seed=0):
+    """
+    Measure how many orders per second MatchingEngine matches in one process, including
+    recording of every fill in the market.
+    """
+    from order_book import MatchingEngine
+
+    names, orders = order_flow(order_count, stock_count, seed)
+    market = _new_market(names)
+    engine = MatchingEngine(market)
+    actions = {'limit': engine.limit_order, 'market': engine.market_order, 'cancel': engine.cancel_order}
+    start = time.perf_counter()
+    for kind, *arguments in orders:
+        actions[kind](*arguments)
+    elapsed = time.perf_counter() - start
+    return {'benchmark': 'order_book', 'orders': order_count, 'stocks': stock_count,
+            'orders_per_second': order_count / elapsed,
+            'trades': sum(len(stock.trade_records) for stock in market.stocks.values()),
+            'resting_orders': len(engine.orders)}
+
+
+def zipf_feed(stock_count, trade_count, exponent=1.1, seed=0, chunk_size=100000):
+    """
+    Return names of stock_count stocks and an iterator of trade_count synthetic trade rows
+    in lists of at most chunk_size, in which stock popularity follows Zipf distribution with
+    exponent (the first stock is the most traded). Rows are made one chunk at a time, so
+    that a feed of 50M trades needs memory for only one chunk, and a feed made again with
+    the same seed has the same rows.
+    """
+    names = ['S%d' % number for number in range(stock_count)]
+
+    def chunks():
+        generator = random.Random(seed)
+        cum_weights = list(itertools.accumulate(1 / rank ** exponent for rank in range(1, stock_count + 1)))
+        for first in range(0, trade_count, chunk_size):
+            chosen = generator.choices(names, cum_weights=cum_weights, k=min(chunk_size, trade_count - first))
+            yield [(name, generator.randint(1, 500), 'BS'[number & 1], round(generator.uniform(50, 150), 2))
+                   for number, name in enumerate(chosen, first)]
+
+    return names, chunks()
+
+
+def _new_market(names):
+    from stock_market import Market
+
+    market = Market()
+    for number, name in enumerate(names):
+        # every fourth stock is preferred, so that both kinds of dividend yield are measured
+        if number % 4 == 3:
+            market.create_stock(name, 'P', 1 + number % 9, 100, 0.02)
+        else:
+            market.create_stock(name, 'C', 1 + number % 9, 100)
+    return market
+
+
+def _per_call(function, calls):
+    """Run function(calls) and return nanoseconds per call."""
+    start = time.perf_counter()
+    function(calls)
+    return (time.perf_counter() - start) / max(calls, 1) * 1e9
+
+
+def _per_trade(record, chunks, trade_count):
+    """Run record(chunk) for every chunk of a feed and return nanoseconds per trade, without making the chunks."""
+    elapsed = 0.0
+    for chunk in chunks:
+        start = time.perf_counter()
+        record(chunk)
+        elapsed += time.perf_counter() - start
+    return elapsed / max(trade_count, 1) * 1e9
+
+
+def bench_case(stock_count, trade_count, exponent=1.1, seed=0, query_count=20000):
+    """Measure every hot path of stock_market on one synthetic workload, fed to it in chunks."""
+    # queries follow the same popularity as trades, the feed starts with the same rows every time
+    names, chunks = zipf_feed(stock_count, min(query_count, trade_count), exponent, seed)
+    queried = [row[0] for chunk in chunks for row in chunk] or names[:1]
+    metrics = {}
+
+    market = _new_market(names)
+    record_trade = market.record_trade
+    def record(chunk):
+        for row in chunk:
+            record_trade(*row)
+    metrics['record_trade_ns'] = _per_trade(record, zipf_feed(stock_count, trade_count, exponent, seed)[1],
+                                            trade_count)
+
+    # only one market holds the feed at a time
+    market = record_trade = None
+    market = _new_market(names)
+    metrics['record_trades_ns'] = _per_trade(market.record_trades,
+                                             zipf_feed(stock_count, trade_count, exponent, seed)[1], trade_count)
+
+    def queries(function, *args):
+        def run(calls):
+            for number in range(calls):
+                function(queried[number % len(queried)], *args)
+        return run
+    metrics['volume_weighted_stock_price_ns'] = _per_call(queries(market.volume_weighted_stock_price), query_count)
+    metrics['dividend_yield_ns'] = _per_call(queries(market.dividend_yield, 100), query_count)
+    # P/E ratio of stocks with Last Dividend 0 is an error, all of them have it positive
+    metrics['pe_ratio_ns'] = _per_call(queries(market.pe_ratio, 100), query_count)
+
+    def index(calls):
+        for _ in range(calls):
+            market.gbce_all_share_index()
+    metrics['gbce_all_share_index_ns'] = _per_call(index, query_count)
+
+    # memory taken by a market which holds the whole feed, chunks are freed before it is measured
+    market = None
+    tracemalloc.start()
+    market = _new_market(names)
+    before = tracemalloc.get_traced_memory()[0]
+    for chunk in zipf_feed(stock_count, trade_count, exponent, seed)[1]:
+        market.record_trades(chunk)
+    chunk = None
+    metrics['memory_bytes_per_trade'] = (tracemalloc.get_traced_memory()[0] - before) / max(trade_count, 1)
+    tracemalloc.stop()
+
+    return {'stocks': stock_count, 'trades': trade_count, 'metrics': metrics}
+
+
+def compare(result, baseline, tolerance):
+    """
+    Return list of metrics which are more than tolerance (0.2 is 20 %) worse than in
+    baseline, for cases present in both. All metrics are better when lower.
+    """
+    baseline_cases = {(case['stocks'], case['trades']): case['metrics'] for case in baseline['results']}
+    regressions = []
+    for case in result['results']:
+        old_metrics = baseline_cases.get((case['stocks'], case['trades']))
+        if old_metrics is None:
+            continue
+        for name, value in case['metrics'].items():
+            old_value = old_metrics.get(name)
+            if old_value and value > old_value * (1 + tolerance):
+                regressions.append({'stocks': case['stocks'], 'trades': case['trades'], 'metric': name,
+                                    'baseline': old_value, 'value': value, 'ratio': value / old_value})
+    return regressions
+
+
+def bench_suite(stock_counts=(10, 1000, 10000), trade_counts=(1000, 100000), exponent=1.1, seed=0,
+                baseline=None, save_baseline=None, tolerance=0.2):
+    """
+    Run bench_case for every combination of stock and trade counts. Results are compared
+    to the baseline file if it is given, and saved as a new baseline if save_baseline is given.
+    """
+    result = {'benchmark': 'suite', 'python': platform.python_version(), 'zipf_exponent': exponent,
+              'seed': seed, 'results': [bench_case(stock_count, trade_count, exponent, seed)
+                                        for stock_count in stock_counts for trade_count in trade_counts]}
+    if baseline is not None:
+        with open(baseline) as file:
+            result['regressions'] = compare(result, json.load(file), tolerance)
+    if save_baseline is not None:
+        with open(save_baseline, 'w') as file:
+            json.dump(result, file, indent=1)
+    return result
+
+
+def _counts(text):
+    return tuple(int(count) for count in text.split(','))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks for stock_market.py.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    import_parser = subparsers.add_parser('import', help='startup cost of importing stock_market')
+    import_parser.add_argument('--repeat', type=int, default=20)
+
+    threads_parser = subparsers.add_parser('threads', help='record_trade throughput against thread count')
+    threads_parser.add_argument('--max-threads', type=int, default=8)
+    threads_parser.add_argument('--trades-per-thread', type=int, default=50000)
+
+    processes_parser = subparsers.add_parser('processes', help='ShardedEngine throughput against process count')
+    processes_parser.add_argument('--max-processes', type=int, default=4)
+    processes_parser.add_argument('--trades', type=int, default=500000)
+    processes_parser.add_argument('--stocks', type=int, default=64)
+
+    server_parser = subparsers.add_parser('server', help='load generator for server.py')
+    server_parser.add_argument('--connections', type=int, default=16)
+    server_parser.add_argument('--requests', type=int, default=5000, help='requests per connection')
+    server_parser.add_argument('--depth', type=int, default=16, help='requests in flight per connection')
+
+    order_book_parser = subparsers.add_parser('order_book', help='MatchingEngine orders per second')
+    order_book_parser.add_argument('--orders', type=int, default=1000000)
+    order_book_parser.add_argument('--stocks', type=int, default=10)
+    order_book_parser.add_argument('--seed', type=int, default=0)
+
+    suite_parser = subparsers.add_parser('suite', help='all hot paths on synthetic Zipf workloads')
+    suite_parser.add_argument('--stocks', type=_counts, default=(10, 1000, 10000),
+                              help='comma separated stock counts')
+    suite_parser.add_argument('--trades', type=_counts, default=(1000, 100000),
+                              help='comma separated trade counts, for example 1000,1000000,50000000')
+    suite_parser.add_argument('--zipf', type=float, default=1.1, help='exponent of stock popularity')
+    suite_parser.add_argument('--seed', type=int, default=0)
+    suite_parser.add_argument('--baseline', help='JSON file of an earlier run to compare with')
+    suite_parser.add_argument('--save-baseline', help='file to store this run in as a baseline')
+    suite_parser.add_argument('--tolerance', type=float, default=0.2,
+                              help='how much slower than baseline counts as regression, 0.2 is 20 %%')
+
+    args = parser.parse_args(argv)
+    if args.benchmark == 'import':
+        result = bench_import(args.repeat)
+    elif args.benchmark == 'threads':
+        result = bench_threads(args.max_threads, args.trades_per_thread)
+    elif args.benchmark == 'processes':
+        result = bench_processes(args.max_processes, args.trades, args.stocks)
+    elif args.benchmark == 'server':
+        result = bench_server(args.connections, args.requests, args.depth)
+    elif args.benchmark == 'order_book':
+        result = bench_order_book(args.orders, args.stocks, args.seed)
+    elif args.benchmark == 'suite':
+        result = bench_suite(args.stocks, args.trades, args.zipf, args.seed, args.baseline,
+                             args.save_baseline, args.tolerance)
+
+    print(json.dumps(result))
+    if result.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+"""
+Clocks which give a Market its time.
+Time is an integer number of nanoseconds since the clock's epoch_ns, which is itself given
+in nanoseconds since the Unix epoch. All stocks of a market share its clock, so their
+trade timestamps can be compared with each other.
+"""
+
+# nanoseconds in a second
+NANOSECONDS = 10**9
+
+
+def to_nanoseconds(seconds):
+    """Convert a duration in seconds to whole nanoseconds."""
+    # multiplied by a float, so that a string given by mistake raises TypeError instead of being repeated
+    return round(seconds * 1e9)
+
+
+class Clock:
+    """Base of the clocks, now() gives the current time in nanoseconds since epoch_ns."""
+    def __init__(self, epoch_ns = None):
+        if epoch_ns is None:
+            # whole second, so that times in seconds convert to timestamps exactly
+            epoch_ns = time.time_ns() // NANOSECONDS * NANOSECONDS
+        self.epoch_ns = epoch_ns
+
+    def now(self):
+        raise NotImplementedError
+
+    def refresh(self):
+        """Called by Market before every batch of trades, only coarse clocks need it."""
+
+    def timestamp(self, seconds):
+        """Convert seconds since the Unix epoch, like time.time(), to nanoseconds since epoch_ns."""
+        return round((seconds - self.epoch_ns // NANOSECONDS) * NANOSECONDS) - self.epoch_ns % NANOSECONDS
+
+    def time(self):
+        """Current time in seconds since the Unix epoch, like time.time()."""
+        return (self.epoch_ns + self.now()) / NANOSECONDS
+
+
+class SystemClock(Clock):
+    """
+    Real time, measured by the monotonic clock, so that it never goes back when
+    the wall clock is adjusted. Wall clock is read only once, to place it on the epoch.
+    """
+    def __init__(self, epoch_ns = None):
+        Clock.__init__(self, epoch_ns)
+        self.offset = time.time_ns() - self.epoch_ns - time.monotonic_ns()
+
+    def now(self):
+        return time.monotonic_ns() + self.offset
+
+
+class CoarseClock(Clock):
+    """
+    Real time which is read only on refresh(), so recording a trade does not read the
+    system clock. Market refreshes it before every batch of trades; callers recording
+    single trades refresh it themselves, for example once per received network packet.
+    """
+    def __init__(self, source = None):
+        self.source = SystemClock() if source is None else source
+        Clock.__init__(self, self.source.epoch_ns)
+        self.cached = self.source.now()
+
+    def now(self):
+        return self.cached
+
+    def refresh(self):
+        self.cached = self.source.now()
+
+
+class SimulatedClock(Clock):
+    """Time which only moves when it is set, for replays and tests."""
+    def __init__(self, epoch_ns = 0, now = 0):
+        Clock.__init__(self, epoch_ns)
+        self.current = now
+
+    def now(self):
+        return self.current
+
+    def set(self, seconds):
+        """Move to seconds since the Unix epoch."""
+        self.current = self.timestamp(seconds)
+
+    def advance(self, seconds):
+        self.current += to_nanoseconds(seconds)
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+import mmap
+import os
+import struct
+import threading
+from array import array
+from itertools import repeat
+
+from stock_market import Error, market as default_market
+
+"""
+Append-only journal of recorded trades, so that they can be recovered after a restart.
+The file is a sequence of blocks, each with trades of one stock. Block starts with a
+header (stock name in 16 bytes, number of trades, epoch_ns of the stock's clock) followed by
+fixed-width columns: timestamps, quantities, prices and sides, exactly as they are kept
+in TradeStore, so that a block is loaded with a few bulk copies instead of parsing rows
+one by one.
+"""
+
+BLOCK_HEADER = struct.Struct('<16sqq')
+# longest stock name which fits into block header
+NAME_LENGTH = 16
+
+
+class TradeJournal:
+    """
+    Writer of the journal.
+    Trades are collected in memory for every stock and written as blocks in one write
+    when group_size of them are collected (group commit) or on commit(). A background
+    thread calls sync() every fsync_interval seconds, so that trades are on disk at most
+    about that long after they were added, also when no more trades come. fsync is never
+    called by the threads which add trades, and is done outside of the lock.
+    Attach it to a Market with market.journal = TradeJournal(path), and close() it.
+    """
+    def __init__(self, path, group_size = 4096, fsync_interval = 0.05):
+        self.path = path
+        self.group_size = group_size
+        self.fsync_interval = fsync_interval
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        # incomplete block left by a crash is cut off, so that new blocks follow the last complete one
+        os.ftruncate(self.fd, complete_length(path))
+        # journal is shared by all shards of a market, so it has its own lock
+        self.lock = threading.Lock()
+        # for every (stock name, epoch_ns), columns of trades not yet written
+        self.pending = {}
+        self.pending_count = 0
+        # whether blocks were written since the last fsync, sync_lock keeps a sync() from
+        #    returning while another one is still in fsync of its blocks
+        self.written = False
+        self.sync_lock = threading.Lock()
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self._flush, daemon=True)
+        self.flusher.start()
+
+    def _flush(self):
+        while not self.closed.wait(self.fsync_interval):
+            self.sync()
+
+    def _columns(self, stock):
+        key = (stock.stock_name, stock.epoch_ns)
+        columns = self.pending.get(key)
+        if columns is None:
+            if len(stock.stock_name.encode('utf-8')) > NAME_LENGTH:
+                raise Error("Stock name " + stock.stock_name + " is too long for the journal.")
+            columns = self.pending[key] = (array('q'), array('d'), array('d'), bytearray())
+        return columns
+
+    def append(self, stock, timestamp, quantity, buy_sell_ind, stock_price):
+        """Add one trade of stock, timestamp as in its trade_records."""
+        with self.lock:
+            columns = self._columns(stock)
+            columns[0].append(timestamp)
+            columns[1].append(quantity)
+            columns[2].append(stock_price)
+            columns[3].append(ord(buy_sell_ind))
+            self.pending_count += 1
+            if self.pending_count >= self.group_size:
+                self._commit()
+
+    def extend(self, stock, timestamps, quantities, sides, stock_prices):
+        """Add trades of stock given as columns like in TradeStore."""
+        with self.lock:
+            columns = self._columns(stock)
+            columns[0].extend(timestamps)
+            columns[1].extend(quantities)
+            columns[2].extend(stock_prices)
+            columns[3].extend(sides)
+            self.pending_count += len(timestamps)
+            if self.pending_count >= self.group_size:
+                self._commit()
+
+    def _commit(self):
+        blocks = []
+        for (stock_name, epoch_ns), (timestamps, quantities, stock_prices, sides) in self.pending.items():
+            blocks.append(BLOCK_HEADER.pack(stock_name.encode('utf-8'), len(timestamps), epoch_ns))
+            blocks.append(timestamps.tobytes())
+            blocks.append(quantities.tobytes())
+            blocks.append(stock_prices.tobytes())
+            # sides are padded, so that every block keeps 8 byte alignment
+            blocks.append(bytes(sides) + bytes(-len(sides) % 8))
+        self.pending = {}
+        self.pending_count = 0
+        if blocks:
+            os.write(self.fd, b''.join(blocks))
+            self.written = True
+
+    def commit(self):
+        """Write all collected trades."""
+        with self.lock:
+            self._commit()
+
+    def sync(self):
+        """Write all collected trades and make sure they are on disk."""
+        with self.sync_lock:
+            with self.lock:
+                self._commit()
+                written, self.written = self.written, False
+            # outside of the lock, trades can be added while the disk catches up
+            if written:
+                os.fsync(self.fd)
+
+    def close(self):
+        self.closed.set()
+        self.flusher.join()
+        self.sync()
+        os.close(self.fd)
+
+
+def _block_size(count):
+    return BLOCK_HEADER.size + 25 * count + (-count % 8)
+
+
+def complete_length(path):
+    """Return length of the journal up to the end of its last complete block."""
+    size = os.path.getsize(path)
+    position = 0
+    with open(path, 'rb') as file:
+        while position + BLOCK_HEADER.size <= size:
+            file.seek(position)
+            count = BLOCK_HEADER.unpack(file.read(BLOCK_HEADER.size))[1]
+            if position + _block_size(count) > size:
+                break
+            position += _block_size(count)
+    return position
+
+
+def read_journal(path):
+    """
+    Yield (stock_name, epoch_ns, timestamps, quantities, sides, stock_prices) for every
+    block in the journal, columns as in TradeStore. Incomplete block at the end, left by
+    a crash while writing, is ignored.
+    """
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as journal, memoryview(journal) as view:
+            size = len(journal)
+            position = 0
+            while position + BLOCK_HEADER.size <= size:
+                name, count, epoch_ns = BLOCK_HEADER.unpack_from(journal, position)
+                start = position + BLOCK_HEADER.size
+                end = position + _block_size(count)
+                if end > size:
+                    break
+
+                timestamps = array('q')
+                timestamps.frombytes(view[start:start + 8 * count])
+                quantities = array('d')
+                quantities.frombytes(view[start + 8 * count:start + 16 * count])
+                stock_prices = array('d')
+                stock_prices.frombytes(view[start + 16 * count:start + 24 * count])
+                sides = view[start + 24 * count:start + 25 * count].tobytes()
+
+                yield (name.rstrip(b'\0').decode('utf-8'), epoch_ns, 
+                       timestamps, quantities, sides, stock_prices)
+                position = end
+
+
+def load_journal(path, market = default_market):
+    """
+    Put trades from the journal to market, whose stocks need to be created already and
+    which should not have a journal attached yet.
+    Return number of loaded trades and set of names of stocks from the journal which
+    are not in the market.
+    """
+    loaded = 0
+    missing = set()
+    for stock_name, epoch_ns, timestamps, quantities, sides, stock_prices in read_journal(path):
+        with market.stocks.shard(stock_name).lock:
+            stock = market.stocks.get(stock_name)
+            if stock is None:
+                missing.add(stock_name)
+                continue
+            # timestamps are moved to the epoch of the market's clock in this process
+            shift = epoch_ns - stock.epoch_ns
+            if shift:
+                timestamps = array('q', map(int.__add__, timestamps, repeat(shift)))
+            market._add_trades(stock, timestamps, quantities, sides, stock_prices)
+        loaded += len(timestamps)
+    return loaded, missing
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import threading
+import time
+from array import array
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import stock_market
+from stock_market import (STOCK_NOT_CREATED, PRICE_NOT_POSITIVE, QUANTITY_NOT_POSITIVE, SIDE_NOT_SET,
+                          ARGUMENTS_NOT_SET)
+
+"""
+Instrumentation of a Market: call counts and latency histograms of its functions, number
+of trades of every stock and counts of rejected trades, exported as a text snapshot in
+the Prometheus text format.
+Functions are measured by wrappers which are put on the market only while metrics are
+enabled, so a market without enabled metrics runs exactly the same code as before.
+"""
+
+# functions of Market which are measured
+INSTRUMENTED = ('create_stock', 'remove_stock', 'record_trade', 'try_record_trade', 'record_trades',
+                'record_trade_columns', 'volume_weighted_stock_price', 'volume_weighted_stock_price_between',
+                'ohlcv_bar', 'dividend_yield', 'pe_ratio', 'dividend_yields', 'pe_ratios',
+                'gbce_all_share_index', 'gbce_all_share_index_low_high', 'snapshot')
+
+REJECTION_NAMES = {
+    STOCK_NOT_CREATED: 'stock_not_created',
+    PRICE_NOT_POSITIVE: 'price_not_positive',
+    QUANTITY_NOT_POSITIVE: 'quantity_not_positive',
+    SIDE_NOT_SET: 'side_not_set',
+    ARGUMENTS_NOT_SET: 'arguments_not_set',
+}
+
+# quantiles of latency put to the snapshot
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class LatencyHistogram:
+    """
+    Histogram of latencies in nanoseconds with buckets of logarithmic size, like HdrHistogram.
+    Every power of two is split into SUB_BUCKETS buckets, so a value is known to within
+    1/SUB_BUCKETS of itself, and memory does not depend on the number of recorded values.
+    """
+    SUB_BUCKETS = 16
+    # values up to 2**MAX_MAGNITUDE nanoseconds (about 18 minutes), longer ones go to the last bucket
+    MAX_MAGNITUDE = 40
+
+    def __init__(self):
+        self.counts = array('q', [0]) * self.bucket((1 << self.MAX_MAGNITUDE) - 1) + array('q', [0])
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def bucket(cls, value):
+        shift = value.bit_length() - cls.SUB_BUCKETS.bit_length()
+        if shift <= 0:
+            return value
+        # value >> shift has the highest bit of SUB_BUCKETS set, so buckets of every shift follow each other
+        return cls.SUB_BUCKETS * shift + (value >> shift)
+
+    @classmethod
+    def lowest_value(cls, bucket):
+        """Lowest value which goes to bucket."""
+        if bucket < 2 * cls.SUB_BUCKETS:
+            return bucket
+        shift = bucket // cls.SUB_BUCKETS - 1
+        return (bucket - cls.SUB_BUCKETS * shift) << shift
+
+    def record(self, value):
+        bucket = min(self.bucket(value), len(self.counts) - 1)
+        with self.lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, quantile):
+        """Return value below which the quantile of recorded values is, 0 if there are none."""
+        with self.lock:
+            rank = quantile * self.count
+            seen = 0
+            for bucket, count in enumerate(self.counts):
+                seen += count
+                if count and seen >= rank:
+                    # middle of the bucket, but never more than the highest recorded value
+                    return min((self.lowest_value(bucket) + self.lowest_value(bucket + 1)) // 2, self.max)
+            return 0
+
+
+class Metrics:
+    """
+    Metrics of a market, collected while enabled. enable() and disable() can be called at
+    any time, also while the market is used from other threads.
+    """
+    def __init__(self, market = stock_market.market):
+        self.market = market
+        self.histograms = {name: LatencyHistogram() for name in INSTRUMENTED}
+        self.errors = dict.fromkeys(INSTRUMENTED, 0)
+        self.enabled = False
+
+    def _timed(self, name, function):
+        histogram = self.histograms[name]
+        perf_counter_ns = time.perf_counter_ns
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                with histogram.lock:
+                    self.errors[name] += 1
+                raise
+            finally:
+                histogram.record(perf_counter_ns() - start)
+        return timed
+
+    def enable(self):
+        """Put measuring wrappers on the market's functions."""
+        if self.enabled:
+            return
+        for name in INSTRUMENTED:
+            timed = self._timed(name, getattr(self.market, name))
+            setattr(self.market, name, timed)
+            # module level functions are the default market's functions too
+            if self.market is stock_market.market:
+                setattr(stock_market, name, timed)
+        self.enabled = True
+
+    def disable(self):
+        """Take the wrappers away, collected metrics are kept."""
+        if not self.enabled:
+            return
+        for name in INSTRUMENTED:
+            delattr(self.market, name)
+            if self.market is stock_market.market:
+                setattr(stock_market, name, getattr(self.market, name))
+        self.enabled = False
+
+    def snapshot(self):
+        """Return all metrics as text in the Prometheus text format."""
+        lines = ['# TYPE stock_market_calls_total counter']
+        for name in INSTRUMENTED:
+            lines.append('stock_market_calls_total{function="%s"} %d' % (name, self.histograms[name].count))
+        lines.append('# TYPE stock_market_errors_total counter')
+        for name in INSTRUMENTED:
+            lines.append('stock_market_errors_total{function="%s"} %d' % (name, self.errors[name]))
+
+        lines.append('# TYPE stock_market_latency_ns summary')
+        for name in INSTRUMENTED:
+            histogram = self.histograms[name]
+            if histogram.count:
+                for quantile in QUANTILES:
+                    lines.append('stock_market_latency_ns{function="%s",quantile="%s"} %d'
+                                 % (name, quantile, histogram.quantile(quantile)))
+                lines.append('stock_market_latency_ns_sum{function="%s"} %d' % (name, histogram.total))
+                lines.append('stock_market_latency_ns_count{function="%s"} %d' % (name, histogram.count))
+
+        lines.append('# TYPE stock_market_trades gauge')
+        with self.market.all_shards_locked():
+            trades = [(stock_name, len(stock.trade_records)) for stock_name, stock in self.market.stocks.items()]
+        for stock_name, count in sorted(trades, key=lambda trade: str(trade[0])):
+            lines.append('stock_market_trades{stock="%s"} %d' % (_label(stock_name), count))
+
+        lines.append('# TYPE stock_market_rejections_total counter')
+        counts = self.market.rejection_counts()
+        for code, reason in sorted(REJECTION_NAMES.items()):
+            lines.append('stock_market_rejections_total{reason="%s"} %d' % (reason, counts.get(code, 0)))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, host = '127.0.0.1', port = 9100):
+        """Serve the snapshot over HTTP from a background thread, return the HTTP server."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.snapshot().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+import math
+import threading
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from itertools import count
+
+import stock_market
+from stock_market import Error
+
+"""
+Limit order books with price-time priority, which generate trades of a Market.
+Every stock has its own OrderBook. Orders at one price wait in a FIFO queue (an OrderedDict
+by order id), prices of every side are kept in a sorted list, and every resting order can
+be found by its id, so an order is cancelled in O(1). Every fill is recorded in the market
+by try_record_trade at the price of the resting order, with the side of the incoming order,
+so Volume Weighted Stock Price and GBCE All Share Index follow the books.
+"""
+
+
+class Order:
+    """Resting limit order, quantity is what is left of it."""
+    __slots__ = ('order_id', 'book', 'buy_sell_ind', 'price', 'quantity')
+
+    def __init__(self, order_id, book, buy_sell_ind, price, quantity):
+        self.order_id = order_id
+        self.book = book
+        self.buy_sell_ind = buy_sell_ind
+        self.price = price
+        self.quantity = quantity
+
+
+class BookSide:
+    """
+    Price levels of one side of a book. Levels are kept by key, which is the price for bids
+    and the negated price for asks, so that the best price always has the highest key and
+    is at the end of the sorted keys, where it is removed in O(1).
+    """
+    __slots__ = ('sign', 'keys', 'levels')
+
+    def __init__(self, sign):
+        self.sign = sign
+        self.keys = []
+        # OrderedDict of orders by their ids, for every key
+        self.levels = {}
+
+    def best(self):
+        """Best price of the side, None if there are no orders."""
+        if self.keys:
+            return self.sign * self.keys[-1]
+        return None
+
+    def add(self, order):
+        key = self.sign * order.price
+        level = self.levels.get(key)
+        if level is None:
+            insort(self.keys, key)
+            level = self.levels[key] = OrderedDict()
+        level[order.order_id] = order
+
+    def remove(self, order):
+        key = self.sign * order.price
+        level = self.levels[key]
+        del level[order.order_id]
+        if not level:
+            del self.levels[key]
+            del self.keys[bisect_left(self.keys, key)]
+
+    def depth(self, levels):
+        """Return list of (price, quantity) of the best levels, best first."""
+        return [(self.sign * key, sum(order.quantity for order in self.levels[key].values()))
+                for key in self.keys[:-levels - 1:-1]]
+
+
+class OrderBook:
+    """Bids and asks of one stock, the lock guards both of them."""
+    def __init__(self, stock_name):
+        self.stock_name = stock_name
+        self.bids = BookSide(1)
+        self.asks = BookSide(-1)
+        self.lock = threading.Lock()
+
+    def side(self, buy_sell_ind):
+        return self.bids if buy_sell_ind == 'B' else self.asks
+
+    def opposite(self, buy_sell_ind):
+        return self.asks if buy_sell_ind == 'B' else self.bids
+
+    def depth(self, levels = 5):
+        """Return (bids, asks), both lists of (price, quantity) of the best levels, best first."""
+        with self.lock:
+            return self.bids.depth(levels), self.asks.depth(levels)
+
+
+class MatchingEngine:
+    """
+    Order books of the stocks of a market. Orders are matched as they arrive: an order
+    trades with the best prices of the other side, and at one price with the oldest orders
+    first. What is left of a limit order rests in the book, what is left of a market order
+    is dropped.
+    """
+    def __init__(self, market = stock_market.market):
+        self.market = market
+        self.books = {}
+        # resting orders by their ids
+        self.orders = {}
+        self.order_ids = count(1)
+
+    def book(self, stock_name):
+        """Return order book of stock_name, a new one if it has none yet."""
+        book = self.books.get(stock_name)
+        if book is None:
+            book = self.books.setdefault(stock_name, OrderBook(stock_name))
+        return book
+
+    def _check(self, stock_name, buy_sell_ind, quantity):
+        if stock_name not in self.market.stocks:
+            raise Error("Stock " + stock_name + " is not yet created.")
+
+        # NaN and infinity are rejected as in Market._trade_code, NaN would be the best price of a book
+        if not 0 < quantity < math.inf:
+            raise Error("Quantity needs to be positive.")
+
+        if buy_sell_ind not in ('B', 'S'):
+            raise Error("Buy or sell indicator is not properly set.")
+
+    def _match(self, book, buy_sell_ind, quantity, limit_price):
+        """
+        Trade quantity against the other side of book up to limit_price (None for any price)
+        and return what is left of it. Caller needs to hold the book's lock.
+        """
+        opposite = book.opposite(buy_sell_ind)
+        keys, levels, sign = opposite.keys, opposite.levels, opposite.sign
+        # prices which can be traded have keys at least this high
+        lowest_key = None if limit_price is None else sign * limit_price
+        try_record_trade = self.market.try_record_trade
+        while quantity > 0 and keys and (lowest_key is None or keys[-1] >= lowest_key):
+            key = keys[-1]
+            level = levels[key]
+            while quantity > 0 and level:
+                order = level[next(iter(level))]
+                traded = min(quantity, order.quantity)
+                # fill is executed only if the market records it, trades of a stock which was removed
+                #    in the meantime are rejected, and then nothing more of the order is matched
+                if try_record_trade(book.stock_name, traded, buy_sell_ind, order.price):
+                    return quantity
+                quantity -= traded
+                order.quantity -= traded
+                if not order.quantity:
+                    level.popitem(last=False)
+                    del self.orders[order.order_id]
+            if not level:
+                del levels[key]
+                keys.pop()
+        return quantity
+
+    def limit_order(self, stock_name, buy_sell_ind, quantity, price):
+        """
+        Match a limit order and return its id. If it is not filled at once, the rest of it
+        waits in the book until it is filled or cancelled.
+        """
+        try:
+            self._check(stock_name, buy_sell_ind, quantity)
+
+            if not 0 < price < math.inf:
+                raise Error("Stock price needs to be positive.")
+
+            book = self.book(stock_name)
+            order_id = next(self.order_ids)
+            with book.lock:
+                quantity = self._match(book, buy_sell_ind, quantity, price)
+                if quantity > 0:
+                    order = Order(order_id, book, buy_sell_ind, price, quantity)
+                    book.side(buy_sell_ind).add(order)
+                    self.orders[order_id] = order
+            return order_id
+
+        except TypeError:
+            raise Error("Please set all arguments correctly.")
+
+    def market_order(self, stock_name, buy_sell_ind, quantity):
+        """Match an order at any price and return the filled quantity, the rest is dropped."""
+        try:
+            self._check(stock_name, buy_sell_ind, quantity)
+
+            book = self.book(stock_name)
+            with book.lock:
+                return quantity - self._match(book, buy_sell_ind, quantity, None)
+
+        except TypeError:
+            raise Error("Please set all arguments correctly.")
+
+    def cancel_order(self, order_id):
+        """Remove a resting order, False is returned if it was already filled or cancelled."""
+        order = self.orders.get(order_id)
+        if order is None:
+            return False
+        with order.book.lock:
+            # it could have been filled before the lock was taken
+            if self.orders.pop(order_id, None) is None:
+                return False
+            order.book.side(order.buy_sell_ind).remove(order)
+            return True
+
+    def remaining_quantity(self, order_id):
+        """Quantity of a resting order which is not filled yet, 0 if it is not in a book."""
+        order = self.orders.get(order_id)
+        return 0 if order is None else order.quantity
+
+    def best_bid(self, stock_name):
+        return self.book(stock_name).bids.best()
+
+    def best_ask(self, stock_name):
+        return self.book(stock_name).asks.best()
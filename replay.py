@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import operator
+from bisect import bisect_left
+from collections import namedtuple
+from itertools import repeat
+
+from clock import NANOSECONDS, SimulatedClock
+from journal import read_journal
+from stock_market import Error, geometric_mean_of_logs
+
+"""
+Replay of historical trades through a Market, for backtesting.
+Trade files are read in chunks of columns, so memory does not grow with the size of
+the file, and every chunk is recorded with bulk record_trades while the market runs on
+a SimulatedClock moved by the trades themselves. Snapshots of Volume Weighted Stock
+Prices and GBCE All Share Index are yielded at fixed intervals of simulated time.
+"""
+
+# columns of a trade file, named as the arguments of record_trade
+COLUMNS = ('timestamp', 'stock_name', 'quantity', 'buy_sell_ind', 'stock_price')
+
+ReplaySnapshot = namedtuple('ReplaySnapshot', 'time prices index recorded rejected')
+ReplaySnapshot.__doc__ = """
+State of the market at simulated time: prices is a dictionary of Volume Weighted Stock
+Prices by stock name, index is GBCE All Share Index (None before the first trade), recorded
+and rejected are numbers of trades replayed so far.
+"""
+
+
+def read_csv(path, chunk_size = 65536):
+    """
+    Yield chunks of trades from a CSV file with a header row containing COLUMNS, as
+    (timestamps, stock_names, quantities, buy_sell_inds, stock_prices) lists.
+    Timestamps are in seconds since the epoch.
+    """
+    with open(path, newline='') as file:
+        reader = csv.reader(file)
+        header = next(reader, None)
+        if header is None:
+            return
+        try:
+            positions = [header.index(column) for column in COLUMNS]
+        except ValueError:
+            raise Error("Trade file needs to have columns " + ', '.join(COLUMNS) + ".")
+
+        while True:
+            rows = [row for _, row in zip(range(chunk_size), reader)]
+            if not rows:
+                return
+            columns = list(zip(*rows))
+            timestamps, stock_names, quantities, buy_sell_inds, stock_prices = [columns[position] for position in positions]
+            yield (list(map(float, timestamps)), list(stock_names), list(map(float, quantities)),
+                   list(buy_sell_inds), list(map(float, stock_prices)))
+
+
+def read_parquet(path, chunk_size = 65536):
+    """Yield chunks of trades like read_csv from a Parquet file, pyarrow needs to be installed."""
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        raise Error("Reading Parquet files needs pyarrow.")
+
+    for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=list(COLUMNS)):
+        yield tuple(batch.column(position).to_pylist() for position in range(len(COLUMNS)))
+
+
+def read_journal_trades(path, chunk_size = 65536):
+    """Yield chunks of trades like read_csv from a journal written by TradeJournal."""
+    chunk = [[], [], [], [], []]
+    for stock_name, epoch_ns, timestamps, quantities, sides, stock_prices in read_journal(path):
+        chunk[0].extend((epoch_ns + timestamp) / NANOSECONDS for timestamp in timestamps)
+        chunk[1].extend(repeat(stock_name, len(timestamps)))
+        chunk[2].extend(quantities)
+        chunk[3].extend(map(chr, sides))
+        chunk[4].extend(stock_prices)
+        # blocks are merged into chunks, as blocks written together hold trades of the same period
+        if len(chunk[0]) >= chunk_size:
+            yield tuple(chunk)
+            chunk = [[], [], [], [], []]
+    if chunk[0]:
+        yield tuple(chunk)
+
+
+def _in_time_order(chunk):
+    timestamps = chunk[0]
+    if not any(map(operator.gt, timestamps, timestamps[1:])):
+        return chunk
+    # stable sort, so that trades with equal timestamps keep their order
+    order = sorted(range(len(timestamps)), key=timestamps.__getitem__)
+    return tuple([column[index] for index in order] for column in chunk)
+
+
+def replay(market, chunks, interval = 60, stock_names = None):
+    """
+    Record trades from chunks (as given by read_csv, read_parquet or read_journal_trades) in
+    market and yield a ReplaySnapshot after every interval seconds of simulated time, and
+    one at the end. Stocks need to be created in market already, trades of other stocks are
+    rejected. Prices in snapshots are for stock_names, or for all stocks of market.
+    Trades are expected in time order across chunks, a trade older than an already yielded
+    snapshot is still recorded, as a late trade.
+    Use a market with a RetentionPolicy to keep its memory bounded as well.
+    """
+    clock = SimulatedClock(market.clock.epoch_ns)
+    real_clock = market.clock
+    market.clock = clock
+    # simulated time in seconds since the Unix epoch
+    now = None
+    recorded = rejected = 0
+    next_snapshot = None
+
+    def snapshot():
+        names = list(market.stocks) if stock_names is None else stock_names
+        return ReplaySnapshot(now, {stock_name: market.volume_weighted_stock_price(stock_name)
+                                    for stock_name in names},
+                              geometric_mean_of_logs(*market.index_parts()), recorded, rejected)
+
+    try:
+        for chunk in chunks:
+            timestamps, names, quantities, buy_sell_inds, stock_prices = _in_time_order(chunk)
+            count = len(timestamps)
+            if next_snapshot is None and count:
+                now = timestamps[0]
+                next_snapshot = now + interval
+
+            start = 0
+            while start < count:
+                end = bisect_left(timestamps, next_snapshot, start)
+                if end > start:
+                    # trades are recorded at the time of the newest one, older ones through time_shift
+                    now = max(now, timestamps[end - 1])
+                    clock.set(now)
+                    failed = market.record_trades(zip(names[start:end], quantities[start:end], buy_sell_inds[start:end],
+                                                      stock_prices[start:end],
+                                                      [now - timestamp for timestamp in timestamps[start:end]]))
+                    rejected += len(failed)
+                    recorded += end - start - len(failed)
+                start = end
+
+                while start < count and timestamps[start] >= next_snapshot:
+                    now = next_snapshot
+                    clock.set(now)
+                    yield snapshot()
+                    next_snapshot += interval
+
+        if next_snapshot is not None:
+            now = next_snapshot
+            clock.set(now)
+            yield snapshot()
+    finally:
+        market.clock = real_clock
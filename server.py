@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import asyncio
+
+from stock_market import Error, market as default_market
+
+"""
+asyncio TCP server which gives access to a Market to many clients.
+Protocol is line based, every request is one line of words separated by spaces and gets
+exactly one response line, in the order in which requests were sent:
+
+    C <stock> <type> <last dividend> <par value> [<fixed dividend>]   create stock
+    T <stock> <quantity> <B|S> <price>                                  record trade
+    DY <stock> <price>                                                  dividend yield
+    PE <stock> <price>                                                  P/E ratio
+    VWSP <stock> [<minutes>]                                            volume weighted stock price
+    BAR <stock> [<minutes>]                                             open, high, low, close, volume
+    GBCE                                                                GBCE All Share Index
+
+Response is "OK" followed by the result, if there is one, or "ERR <message>".
+Clients can send many requests without waiting for responses (pipelining), responses
+to all requests which arrived together are written at once.
+"""
+
+# connection which sends a longer line than this is closed
+MAX_LINE_LENGTH = 4096
+
+
+def _number(text):
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def _create_stock(market, stock_name, stock_type, last_dividend, par_value, fixed_dividend = None):
+    return market.create_stock(stock_name, stock_type, _number(last_dividend), _number(par_value),
+                               None if fixed_dividend is None else _number(fixed_dividend))
+
+
+def _record_trade(market, stock_name, quantity, buy_sell_ind, stock_price):
+    return market.record_trade(stock_name, _number(quantity), buy_sell_ind, _number(stock_price))
+
+
+def _dividend_yield(market, stock_name, stock_price):
+    return market.dividend_yield(stock_name, _number(stock_price))
+
+
+def _pe_ratio(market, stock_name, stock_price):
+    return market.pe_ratio(stock_name, _number(stock_price))
+
+
+def _volume_weighted_stock_price(market, stock_name, minutes = None):
+    if minutes is None:
+        return market.volume_weighted_stock_price(stock_name)
+    return market.volume_weighted_stock_price(stock_name, int(minutes))
+
+
+def _ohlcv_bar(market, stock_name, minutes = None):
+    if minutes is None:
+        return market.ohlcv_bar(stock_name)
+    return market.ohlcv_bar(stock_name, int(minutes))
+
+
+def _gbce_all_share_index(market):
+    return market.gbce_all_share_index()
+
+
+COMMANDS = {
+    b'C': _create_stock,
+    b'T': _record_trade,
+    b'DY': _dividend_yield,
+    b'PE': _pe_ratio,
+    b'VWSP': _volume_weighted_stock_price,
+    b'BAR': _ohlcv_bar,
+    b'GBCE': _gbce_all_share_index,
+}
+
+
+def handle_request(market, line):
+    """Run one request line on market and return its response line."""
+    words = line.split()
+    if not words:
+        return b'ERR Empty request.\n'
+    command = COMMANDS.get(words[0])
+    if command is None:
+        return b'ERR Unknown command.\n'
+    try:
+        result = command(market, *[word.decode('utf-8') for word in words[1:]])
+    except Error as error:
+        return b'ERR ' + str(error).encode('utf-8') + b'\n'
+    except (TypeError, ValueError, UnicodeDecodeError):
+        return b'ERR Please set all arguments correctly.\n'
+    if result is None:
+        return b'OK\n'
+    return b'OK ' + repr(result).encode('utf-8') + b'\n'
+
+
+class MarketProtocol(asyncio.Protocol):
+    """One client connection."""
+    def __init__(self, market):
+        self.market = market
+        self.transport = None
+        self.buffer = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        buffer = self.buffer
+        buffer += data
+        end = buffer.rfind(b'\n')
+        if end < 0:
+            if len(buffer) > MAX_LINE_LENGTH:
+                self.transport.close()
+            return
+
+        market = self.market
+        # a coarse clock is read once for all requests which arrived together
+        market.clock.refresh()
+        lines = bytes(buffer[:end]).split(b'\n')
+        del buffer[:end + 1]
+        # responses to all complete requests are coalesced into one write
+        self.transport.write(b''.join([handle_request(market, line) for line in lines]))
+
+    def pause_writing(self):
+        # client does not read its responses, so its requests are not read either
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+
+async def start_server(market = default_market, host = '127.0.0.1', port = 8765):
+    """Start serving market and return asyncio Server."""
+    loop = asyncio.get_running_loop()
+    return await loop.create_server(lambda: MarketProtocol(market), host, port)
+
+
+async def _serve_forever(host, port):
+    server = await start_server(default_market, host, port)
+    address = server.sockets[0].getsockname()
+    print('listening on', address[0], address[1], flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Market data server for stock_market.py.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765, help='0 picks a free port')
+    args = parser.parse_args(argv)
+    asyncio.run(_serve_forever(args.host, args.port))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+import queue
+import threading
+import time
+import zlib
+
+from clock import SystemClock
+from stock_market import VWSP_WINDOW_LENGTH, Error, Market, geometric_mean_of_logs
+
+"""
+Trade engine which splits stocks across worker processes, so that trades are recorded
+on more than one core.
+Every worker owns a Market with the stocks whose names hash to it. Trades are sent to
+workers in batches, and GBCE All Share Index is put together from the parts of the
+index every worker keeps (sum of logarithms of last prices and number of traded stocks).
+"""
+
+
+def _time_shift(time_shift, delay):
+    try:
+        return time_shift + delay
+    except TypeError:
+        # wrong time_shift is left as it is, so that the trade is rejected by Market
+        return time_shift
+
+
+def _send_replies(connection, replies):
+    """Send replies of a worker until None is put to replies."""
+    while True:
+        reply = replies.get()
+        if reply is None:
+            break
+        connection.send(reply)
+
+
+def _worker(connection, epoch_ns):
+    """Main loop of a worker process, runs commands sent by ShardedEngine."""
+    # all workers share the epoch, so their timestamps can be compared
+    market = Market(shard_count = 1, clock = SystemClock(epoch_ns))
+    # replies are sent by their own thread, so that a reply bigger than the pipe, which the engine
+    #    does not read while it is sending the next batch, never stops this loop from receiving it
+    replies = queue.Queue()
+    sender = threading.Thread(target=_send_replies, args=(connection, replies))
+    sender.start()
+    while True:
+        command, args = connection.recv()
+        if command == 'stop':
+            break
+        try:
+            if command == 'record_trades':
+                # trades carry the time they were recorded at, it is turned into time_shift
+                now = time.time()
+                result = market.record_trades([(stock_name, quantity, buy_sell_ind, stock_price,
+                                                _time_shift(time_shift, now - recorded_at))
+                                               for stock_name, quantity, buy_sell_ind, stock_price, time_shift,
+                                                   recorded_at in args])
+            else:
+                result = getattr(market, command)(*args)
+            replies.put(('ok', result))
+        except Exception as error:
+            # every command gets a reply, otherwise the engine would wait forever
+            replies.put(('error', str(error)))
+    replies.put(None)
+    sender.join()
+    connection.close()
+
+
+class ShardedEngine:
+    """
+    Market whose stocks are split across worker processes.
+    It has the same functions as Market. Recorded trades are kept in a buffer for every
+    worker and sent when batch_size of them are collected, before any query of that worker,
+    or on flush(). Trades rejected by workers are collected in rejected as
+    (trade, message) pairs, after flush() all of them are there. If a worker fails on
+    a batch, every trade of it is there with the message of the error.
+    """
+    # workers can be this many batches behind before the engine waits for them,
+    #    so that their replies cannot fill up the pipes
+    MAX_OUTSTANDING_BATCHES = 8
+
+    def __init__(self, process_count = None, batch_size = 10000):
+        self.process_count = process_count or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self.connections = []
+        self.processes = []
+        self.epoch_ns = SystemClock().epoch_ns
+        for _ in range(self.process_count):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_worker, args=(worker_connection, self.epoch_ns), daemon=True)
+            process.start()
+            worker_connection.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+        # trades waiting to be sent, for every worker
+        self.pending = [[] for _ in range(self.process_count)]
+        # for every worker, batches sent and not yet confirmed
+        self.outstanding = [[] for _ in range(self.process_count)]
+        self.rejected = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def worker(self, stock_name):
+        """Return number of the worker which owns stock_name, the same in every process."""
+        return zlib.crc32(str(stock_name).encode('utf-8')) % self.process_count
+
+    def _send_batch(self, worker):
+        batch = self.pending[worker]
+        if not batch:
+            return
+        if len(self.outstanding[worker]) >= self.MAX_OUTSTANDING_BATCHES:
+            self._wait(worker)
+        self.pending[worker] = []
+        self.connections[worker].send(('record_trades', batch))
+        self.outstanding[worker].append(batch)
+
+    def _wait(self, worker):
+        """Receive replies to all batches sent to worker."""
+        connection = self.connections[worker]
+        for batch in self.outstanding[worker]:
+            status, result = connection.recv()
+            if status == 'ok':
+                self.rejected.extend((batch[row_number][:4], message) for row_number, message in result)
+            else:
+                # Market failed on the whole batch, not on some of its rows, so none of its trades were recorded
+                self.rejected.extend((trade[:4], result) for trade in batch)
+        self.outstanding[worker] = []
+
+    def _call(self, worker, command, *args):
+        """Run command in worker after all trades sent to it were recorded and return its result."""
+        self._send_batch(worker)
+        self._wait(worker)
+        connection = self.connections[worker]
+        connection.send((command, args))
+        status, result = connection.recv()
+        if status == 'error':
+            raise Error(result)
+        return result
+
+    def _call_all(self, command, *args):
+        """Run command in all workers at once and return list of their results."""
+        for worker in range(self.process_count):
+            self._send_batch(worker)
+            self._wait(worker)
+            self.connections[worker].send((command, args))
+        results = [connection.recv() for connection in self.connections]
+        for status, result in results:
+            if status == 'error':
+                raise Error(result)
+        return [result for _, result in results]
+
+    def flush(self):
+        """Send all buffered trades and wait until workers have recorded them."""
+        for worker in range(self.process_count):
+            self._send_batch(worker)
+        for worker in range(self.process_count):
+            self._wait(worker)
+
+    def close(self):
+        self.flush()
+        for connection in self.connections:
+            connection.send(('stop', ()))
+        for process in self.processes:
+            process.join()
+        for connection in self.connections:
+            connection.close()
+
+    def create_stock(self, stock_name, stock_type, last_dividend, par_value, fixed_dividend = None):
+        return self._call(self.worker(stock_name), 'create_stock', stock_name, stock_type,
+                          last_dividend, par_value, fixed_dividend)
+
+    def remove_stock(self, stock_name):
+        return self._call(self.worker(stock_name), 'remove_stock', stock_name)
+
+    def change_stock_type(self, stock_name, new_stock_type, new_fixed_dividend = None):
+        return self._call(self.worker(stock_name), 'change_stock_type', stock_name, new_stock_type,
+                          new_fixed_dividend)
+
+    def change_last_dividend(self, stock_name, new_last_dividend):
+        return self._call(self.worker(stock_name), 'change_last_dividend', stock_name, new_last_dividend)
+
+    def change_par_value(self, stock_name, new_par_value):
+        return self._call(self.worker(stock_name), 'change_par_value', stock_name, new_par_value)
+
+    def change_fixed_dividend(self, stock_name, new_fixed_dividend):
+        return self._call(self.worker(stock_name), 'change_fixed_dividend', stock_name, new_fixed_dividend)
+
+    def dividend_yield(self, stock_name, stock_price):
+        return self._call(self.worker(stock_name), 'dividend_yield', stock_name, stock_price)
+
+    def pe_ratio(self, stock_name, stock_price):
+        return self._call(self.worker(stock_name), 'pe_ratio', stock_name, stock_price)
+
+    def _call_split(self, command, stock_names, stock_prices):
+        """Run command of Market which takes columns of names and prices in every worker with its part of them."""
+        import numpy
+
+        stock_names = list(stock_names)
+        stock_prices = numpy.asarray(stock_prices, dtype=float)
+        if stock_prices.shape != (len(stock_names),):
+            raise Error("Columns need to be of the same length.")
+        positions = [[] for _ in range(self.process_count)]
+        for position, stock_name in enumerate(stock_names):
+            positions[self.worker(stock_name)].append(position)
+
+        result = numpy.full(len(stock_names), numpy.nan)
+        for worker, worker_positions in enumerate(positions):
+            if worker_positions:
+                result[worker_positions] = self._call(worker, command, [stock_names[position] for position in worker_positions],
+                                                      stock_prices[worker_positions])
+        return result
+
+    def dividend_yields(self, stock_names, stock_prices):
+        return self._call_split('dividend_yields', stock_names, stock_prices)
+
+    def pe_ratios(self, stock_names, stock_prices):
+        return self._call_split('pe_ratios', stock_names, stock_prices)
+
+    def record_trade(self, stock_name, quantity, buy_sell_ind, stock_price, time_shift = 0):
+        worker = self.worker(stock_name)
+        batch = self.pending[worker]
+        batch.append((stock_name, quantity, buy_sell_ind, stock_price, time_shift, time.time()))
+        if len(batch) >= self.batch_size:
+            self._send_batch(worker)
+
+    def record_trades(self, trades):
+        """Buffer many (stock_name, quantity, buy_sell_ind, stock_price[, time_shift]) rows."""
+        now = time.time()
+        worker_of = {}
+        pending = self.pending
+        for row in trades:
+            if len(row) < 4:
+                self.rejected.append((tuple(row), "Please set all arguments correctly."))
+                continue
+            stock_name = row[0]
+            worker = worker_of.get(stock_name)
+            if worker is None:
+                worker = worker_of[stock_name] = self.worker(stock_name)
+            pending[worker].append((stock_name, row[1], row[2], row[3], row[4] if len(row) > 4 else 0, now))
+        for worker in range(self.process_count):
+            if len(pending[worker]) >= self.batch_size:
+                self._send_batch(worker)
+
+    def volume_weighted_stock_price(self, stock_name, minutes = VWSP_WINDOW_LENGTH):
+        return self._call(self.worker(stock_name), 'volume_weighted_stock_price', stock_name, minutes)
+
+    def ohlcv_bar(self, stock_name, minutes = VWSP_WINDOW_LENGTH):
+        return self._call(self.worker(stock_name), 'ohlcv_bar', stock_name, minutes)
+
+    def volume_weighted_stock_price_between(self, stock_name, time_from, time_to):
+        return self._call(self.worker(stock_name), 'volume_weighted_stock_price_between', stock_name,
+                          time_from, time_to)
+
+    def index_parts(self):
+        parts = self._call_all('index_parts')
+        return sum(part[0] for part in parts), sum(part[1] for part in parts)
+
+    def gbce_all_share_index(self):
+        """GBCE All Share Index put together from the parts kept by the workers."""
+        index = geometric_mean_of_logs(*self.index_parts())
+        if index is None:
+            raise Error("There are no trade records.")
+
+        return index
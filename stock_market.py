@@ -1,7 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import logging
+import math
+import operator
+import threading
 import time
-from scipy.stats.mstats import gmean
+from array import array
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from bisect import bisect_left, bisect_right
+from itertools import count, repeat
+
+from clock import NANOSECONDS, SystemClock, to_nanoseconds
 
 """
 This is the main file where all the classes and functions are defined for using
@@ -9,17 +19,453 @@ simple stock market.
 Comments are put only to places where they really enhance understanding.
 """
 
+# length of the window used for Volume Weighted Stock Price, specified in minutes
+VWSP_WINDOW_LENGTH = 15
+# lengths of the windows for which Volume Weighted Stock Price and OHLCV bars are kept, in minutes
+BAR_RESOLUTIONS = (1, 5, 15, 60)
+
+# result codes of try_record_trade, every rejection has its own
+RECORDED = 0
+STOCK_NOT_CREATED = 1
+PRICE_NOT_POSITIVE = 2
+QUANTITY_NOT_POSITIVE = 3
+SIDE_NOT_SET = 4
+ARGUMENTS_NOT_SET = 5
+
+REJECTION_MESSAGES = {
+    STOCK_NOT_CREATED: "Stock %s is not yet created.",
+    PRICE_NOT_POSITIVE: "Stock price needs to be positive.",
+    QUANTITY_NOT_POSITIVE: "Quantity needs to be positive.",
+    SIDE_NOT_SET: "Buy or sell indicator is not properly set.",
+    ARGUMENTS_NOT_SET: "Please set all arguments correctly.",
+}
+
+
+def rejection_message(code, stock_name):
+    """Message of Error raised for a trade rejected with code."""
+    if code == STOCK_NOT_CREATED:
+        return REJECTION_MESSAGES[code] % stock_name
+    return REJECTION_MESSAGES[code]
+
+
+class TradeStore:
+    """
+    Columnar storage of stock's trades, kept ordered by timestamp.
+    Every column is a typed array, so one trade takes 25 bytes instead of a tuple with
+    its own number objects, and columns can be handed to NumPy without copying
+    (numpy.frombuffer). Arrays over-allocate geometrically, so append is amortized O(1).
+    Running totals of quantity and quantity*price are kept at the end of every block of
+    TOTALS_BLOCK trades (a quarter of a byte per trade), so the sums over any range of trades
+    are a difference of two totals plus at most two partial blocks, and Volume Weighted Stock
+    Price between two timestamps is found in O(log n).
+    Indexing and iterating still give (timestamp, quantity, buy_sell_ind, price) tuples.
+    """
+    TOTALS_BLOCK = 64
+
+    def __init__(self):
+        self.timestamps = array('q')
+        self.quantities = array('d')
+        self.prices = array('d')
+        # one byte per trade, ord('B') or ord('S')
+        self.sides = bytearray()
+        # sums of quantity and of quantity*price of all trades before the end of every full block
+        self.quantity_totals = array('d')
+        self.notional_totals = array('d')
+        # number of oldest trades dropped by RetentionPolicy
+        self.dropped = 0
+
+    def append(self, timestamp, quantity, buy_sell_ind, stock_price):
+        # conversions are done first, so that a bad value cannot leave columns of different lengths
+        quantity = float(quantity)
+        stock_price = float(stock_price)
+        side = ord(buy_sell_ind)
+        self.timestamps.append(timestamp)
+        self.quantities.append(quantity)
+        self.prices.append(stock_price)
+        self.sides.append(side)
+        if not len(self.timestamps) % self.TOTALS_BLOCK:
+            self._total_from(len(self.timestamps) - 1)
+
+    def _partial_sums(self, first, last):
+        quantities = self.quantities[first:last]
+        return sum(quantities), sum(map(operator.mul, quantities, self.prices[first:last]))
+
+    def _total_from(self, start):
+        """Compute block totals again for blocks from the one holding trade start on, after trades were changed."""
+        block_size = self.TOTALS_BLOCK
+        quantity_totals, notional_totals = self.quantity_totals, self.notional_totals
+        block = start // block_size
+        del quantity_totals[block:]
+        del notional_totals[block:]
+        quantity_total = quantity_totals[-1] if block else 0.0
+        notional_total = notional_totals[-1] if block else 0.0
+        for first in range(block * block_size, len(self.quantities) - block_size + 1, block_size):
+            quantity_sum, quantity_price_sum = self._partial_sums(first, first + block_size)
+            quantity_total += quantity_sum
+            notional_total += quantity_price_sum
+            quantity_totals.append(quantity_total)
+            notional_totals.append(notional_total)
+
+    def insert(self, timestamp, quantity, buy_sell_ind, stock_price):
+        """
+        Add trade so that trades stay ordered by timestamp and return its position.
+        Trades with equal timestamps keep the order in which they were added.
+        """
+        timestamps = self.timestamps
+        if not timestamps or timestamps[-1] <= timestamp:
+            position = len(timestamps)
+            self.append(timestamp, quantity, buy_sell_ind, stock_price)
+            return position
+        
+        # late trade, binary search finds its place and only newer trades are moved
+        position = bisect_right(timestamps, timestamp)
+        quantity = float(quantity)
+        stock_price = float(stock_price)
+        side = ord(buy_sell_ind)
+        timestamps.insert(position, timestamp)
+        self.quantities.insert(position, quantity)
+        self.prices.insert(position, stock_price)
+        self.sides.insert(position, side)
+
+        # every block from the one of position on gains the new trade and passes its last one to the next block
+        block_size = self.TOTALS_BLOCK
+        quantities, prices = self.quantities, self.prices
+        quantity_totals, notional_totals = self.quantity_totals, self.notional_totals
+        notional = quantity * stock_price
+        for block in range(position // block_size, len(quantity_totals)):
+            end = (block + 1) * block_size
+            quantity_totals[block] += quantity - quantities[end]
+            notional_totals[block] += notional - quantities[end] * prices[end]
+        if not len(timestamps) % block_size:
+            self._total_from(len(timestamps) - 1)
+        return position
+
+    def extend(self, timestamps, quantities, sides, stock_prices):
+        """
+        Append many trades given as columns of the same types as the stored ones,
+        sides as bytes of b'B' and b'S'.
+        Columns are only appended when their timestamps are not older than the last stored
+        trade, otherwise nothing is added and False is returned.
+        """
+        if timestamps and self.timestamps and timestamps[0] < self.timestamps[-1]:
+            return False
+        start = len(self.timestamps)
+        self.timestamps.extend(timestamps)
+        self.quantities.extend(quantities)
+        self.prices.extend(stock_prices)
+        self.sides.extend(sides)
+        self._total_from(start)
+        return True
+
+    def bounds(self, timestamp_from, timestamp_to):
+        """Return index range of trades with timestamp_from <= timestamp <= timestamp_to."""
+        return (bisect_left(self.timestamps, timestamp_from),
+                bisect_right(self.timestamps, timestamp_to))
+
+    def _sums_before(self, index):
+        """Sum of quantities and sum of quantity*price of trades before index."""
+        block = index // self.TOTALS_BLOCK
+        quantity_sum, quantity_price_sum = self._partial_sums(block * self.TOTALS_BLOCK, index)
+        if block:
+            quantity_sum += self.quantity_totals[block - 1]
+            quantity_price_sum += self.notional_totals[block - 1]
+        return quantity_sum, quantity_price_sum
+
+    def sums(self, first, last):
+        """Return sum of quantities and sum of quantity*price of trades with indices first to last - 1."""
+        if last - first <= 2 * self.TOTALS_BLOCK:
+            # short ranges are summed directly, which also keeps them exact
+            return self._partial_sums(first, max(first, last))
+        quantity_end, quantity_price_end = self._sums_before(last)
+        quantity_start, quantity_price_start = self._sums_before(first)
+        return quantity_end - quantity_start, quantity_price_end - quantity_price_start
+
+    def volume_weighted_price(self, timestamp_from, timestamp_to):
+        """Volume Weighted Stock Price of trades between two timestamps, 0 if there are none."""
+        quantity_sum, quantity_price_sum = self.sums(*self.bounds(timestamp_from, timestamp_to))
+        if quantity_sum > 0:
+            return quantity_price_sum / quantity_sum
+        return 0
+
+    def drop_oldest(self, drop_count):
+        """Remove drop_count oldest trades and return their columns."""
+        dropped = (self.timestamps[:drop_count], self.quantities[:drop_count], bytes(self.sides[:drop_count]),
+                   self.prices[:drop_count])
+        del self.timestamps[:drop_count]
+        del self.quantities[:drop_count]
+        del self.prices[:drop_count]
+        del self.sides[:drop_count]
+        # totals start again from the oldest kept trade, so they do not grow without bounds
+        self._total_from(0)
+        self.dropped += drop_count
+        return dropped
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(zip(self.timestamps[index], self.quantities[index],
+                            map(chr, self.sides[index]), self.prices[index]))
+        return (self.timestamps[index], self.quantities[index], chr(self.sides[index]), self.prices[index])
+
+    def __iter__(self):
+        return zip(self.timestamps, self.quantities, map(chr, self.sides), self.prices)
+
+    def __reversed__(self):
+        return iter(self[::-1])
+
+    def __eq__(self, other):
+        if isinstance(other, TradeStore):
+            other = other[:]
+        return self[:] == other
+
+    def __repr__(self):
+        return repr(self[:])
+
+
+class RetentionPolicy:
+    """
+    Which old trades are dropped from trade_records as new ones arrive.
+    Trades older than max_age seconds and the oldest trades over max_trades are dropped,
+    but never trades still inside any of the stock's bar windows or the newest trade,
+    whose price is used in GBCE All Share Index, so RetentionPolicy(max_age = 0) keeps only those.
+    Dropped trades are passed to spill(stock, timestamps, quantities, sides, stock_prices)
+    if it is given, for example to extend of a TradeJournal used as a cold store.
+    """
+    # trades are dropped only when at least this many, and at least 1/8 of the kept ones
+    #    can go, so that moving the kept trades is amortized O(1) per recorded trade
+    MIN_DROP = 64
+
+    def __init__(self, max_age = None, max_trades = None, spill = None):
+        self.max_age = max_age
+        self.max_trades = max_trades
+        self.spill = spill
+
+    def droppable(self, records, timestamp):
+        """Return how many oldest trades are over the limits at timestamp, as in trade_records."""
+        drop_count = 0
+        if self.max_trades is not None:
+            drop_count = len(records) - self.max_trades
+        if self.max_age is not None:
+            drop_count = max(drop_count, bisect_left(records.timestamps, timestamp - to_nanoseconds(self.max_age)))
+        return drop_count
+
+
+class VolumeWindow:
+    """
+    Running sums of quantity and quantity*price for trades inside a sliding time window.
+    The window is the tail of trade_records starting at head. New trades are added to the
+    sums when they are recorded and expired ones are evicted by moving head forward,
+    so a query only touches trades which have left the window.
+    """
+    def __init__(self, trade_records, window_length):
+        self.trade_records = trade_records
+        # in the same unit as timestamps, nanoseconds in a Market
+        self.window_length = window_length
+        # index of the oldest trade in the window
+        self.head = 0
+        self.quantity_sum = 0
+        self.quantity_price_sum = 0
+
+    def add(self, position, quantity, stock_price):
+        """Add the trade which was just inserted to trade_records at position."""
+        if position < self.head:
+            # trade is older than the window, it only moves the window's trades by one
+            self.head += 1
+            return
+        self.quantity_sum += quantity
+        self.quantity_price_sum += quantity * stock_price
+
+    def add_many(self, timestamps, quantities, stock_prices):
+        """Add trades which were just appended to the end of trade_records."""
+        self.quantity_sum += sum(quantities)
+        self.quantity_price_sum += sum(map(float.__mul__, quantities, stock_prices))
+
+    def evict(self, boundary_timestamp):
+        """Drop trades with timestamps lower than boundary_timestamp."""
+        records = self.trade_records
+        timestamps, quantities, prices = records.timestamps, records.quantities, records.prices
+        head, trade_count = self.head, len(timestamps)
+        while head < trade_count and timestamps[head] < boundary_timestamp:
+            quantity = quantities[head]
+            self.quantity_sum -= quantity
+            self.quantity_price_sum -= quantity * prices[head]
+            head += 1
+        self.head = head
+        if head == trade_count:
+            # start again from exact zeros, so that float rounding does not pile up
+            self.quantity_sum = 0
+            self.quantity_price_sum = 0
+
+    def price(self, boundary_timestamp):
+        self.evict(boundary_timestamp)
+        if self.quantity_sum > 0:
+            return self.quantity_price_sum / self.quantity_sum
+        return 0
+
+
+class BarWindow(VolumeWindow):
+    """
+    VolumeWindow which also gives open, high, low and close price of its trades.
+    High and low are kept in monotonic deques of (timestamp, price) pairs: prices in highs
+    decrease and in lows increase, so the highest and lowest price are always at the front.
+    Pairs are keyed by timestamps, which trades inserted before them or dropped by
+    RetentionPolicy do not change, and which eviction compares with the boundary anyway.
+    A late trade inside the window only marks the deques stale, they are filled again
+    by the next bar(), so any number of late trades costs one rebuild.
+    """
+    def __init__(self, trade_records, window_length):
+        VolumeWindow.__init__(self, trade_records, window_length)
+        self.highs = deque()
+        self.lows = deque()
+        self.stale = False
+
+    def _push(self, timestamp, stock_price):
+        highs, lows = self.highs, self.lows
+        while highs and highs[-1][1] <= stock_price:
+            highs.pop()
+        highs.append((timestamp, stock_price))
+        while lows and lows[-1][1] >= stock_price:
+            lows.pop()
+        lows.append((timestamp, stock_price))
+
+    def _rebuild(self):
+        """Fill the deques again from the trades in the window."""
+        self.highs.clear()
+        self.lows.clear()
+        records = self.trade_records
+        for timestamp, stock_price in zip(records.timestamps[self.head:], records.prices[self.head:]):
+            self._push(timestamp, stock_price)
+        self.stale = False
+
+    def add(self, position, quantity, stock_price):
+        """Add a late trade, which was inserted to trade_records before the newest one."""
+        if position < self.head:
+            # trade is older than the window, it only moves the window's trades by one
+            self.head += 1
+            return
+        self.quantity_sum += quantity
+        self.quantity_price_sum += quantity * stock_price
+        self.stale = True
+
+    def append(self, timestamp, quantity, stock_price):
+        """Add the trade which was just appended as the newest one of trade_records."""
+        self.quantity_sum += quantity
+        self.quantity_price_sum += quantity * stock_price
+        if not self.stale:
+            # _push written out, as this runs for every window with every trade
+            highs, lows = self.highs, self.lows
+            while highs and highs[-1][1] <= stock_price:
+                highs.pop()
+            highs.append((timestamp, stock_price))
+            while lows and lows[-1][1] >= stock_price:
+                lows.pop()
+            lows.append((timestamp, stock_price))
+
+    def add_many(self, timestamps, quantities, stock_prices):
+        VolumeWindow.add_many(self, timestamps, quantities, stock_prices)
+        if not self.stale:
+            for timestamp, stock_price in zip(timestamps, stock_prices):
+                self._push(timestamp, stock_price)
+
+    def evict(self, boundary_timestamp):
+        VolumeWindow.evict(self, boundary_timestamp)
+        highs, lows = self.highs, self.lows
+        if self.head == len(self.trade_records):
+            highs.clear()
+            lows.clear()
+            self.stale = False
+        elif not self.stale:
+            while highs[0][0] < boundary_timestamp:
+                highs.popleft()
+            while lows[0][0] < boundary_timestamp:
+                lows.popleft()
+
+    def bar(self, boundary_timestamp):
+        """Return (open, high, low, close, volume) of the window, or None if it has no trades."""
+        self.evict(boundary_timestamp)
+        prices = self.trade_records.prices
+        if self.head == len(prices):
+            return None
+        if self.stale:
+            self._rebuild()
+        return (prices[self.head], self.highs[0][1], self.lows[0][1], prices[-1], float(self.quantity_sum))
+
+
+class BarAggregator:
+    """
+    BarWindow for every configured resolution, all of them updated with each recorded trade,
+    so that no query needs to scan the trades again.
+    """
+    def __init__(self, trade_records, resolutions = BAR_RESOLUTIONS):
+        self.trade_records = trade_records
+        # window used by volume_weighted_stock_price is always kept
+        self.windows = {minutes: BarWindow(trade_records, minutes * 60 * NANOSECONDS)
+                        for minutes in sorted(set(resolutions) | {VWSP_WINDOW_LENGTH})}
+
+    def window(self, minutes):
+        window = self.windows.get(minutes)
+        if window is None:
+            raise Error("Window of " + str(minutes) + " minutes is not configured.")
+        return window
+
+    def add(self, position, quantity, stock_price):
+        """Add the trade which was just inserted to trade_records at position."""
+        records = self.trade_records
+        if position == len(records) - 1:
+            timestamp, stock_price = records.timestamps[position], records.prices[position]
+            for window in self.windows.values():
+                window.append(timestamp, quantity, stock_price)
+        else:
+            # late trade, only windows which it falls in are marked stale
+            for window in self.windows.values():
+                window.add(position, quantity, stock_price)
+
+    def add_many(self, timestamps, quantities, stock_prices):
+        for window in self.windows.values():
+            window.add_many(timestamps, quantities, stock_prices)
+
+    def evict(self, timestamp):
+        """Move every window to end at timestamp, as in trade_records, and return the lowest head."""
+        head = None
+        for window in self.windows.values():
+            window.evict(timestamp - window.window_length)
+            head = window.head if head is None else min(head, window.head)
+        return head
+
+    def drop_oldest(self, drop_count):
+        """Move heads after drop_count oldest trades were dropped, all of them need to be outside windows."""
+        for window in self.windows.values():
+            window.head -= drop_count
+
+
 class Stock:
     """Main class for storing stock info."""    
-    def __init__(self, stock_name, stock_type, last_dividend, par_value, fixed_dividend):
+    # no per-instance __dict__, every stock only keeps these attributes
+    __slots__ = ('stock_name', 'stock_type', 'last_dividend', 'par_value', 'fixed_dividend',
+                 'epoch_ns', 'trade_records', 'bars', 'volume_window', 'stock_id', 'version',
+                 'reference_version')
+
+    def __init__(self, stock_name, stock_type, last_dividend, par_value, fixed_dividend,
+                 resolutions = BAR_RESOLUTIONS, epoch_ns = 0):
         self.stock_name = stock_name
         self.stock_type = stock_type[:1].upper()
         self.last_dividend = last_dividend
         self.par_value = par_value
         self.fixed_dividend = fixed_dividend
-        # timestamp_start is used so that in trade_records we are not dealing with big numbers
-        self.timestamp_start = round(time.time())        
-        self.trade_records = []
+        # timestamps in trade_records are nanoseconds since epoch_ns of the market's clock
+        self.epoch_ns = epoch_ns
+        self.trade_records = TradeStore()
+        # running sums, highs and lows for every resolution, updated by record_trade
+        self.bars = BarAggregator(self.trade_records, resolutions)
+        self.volume_window = self.bars.windows[VWSP_WINDOW_LENGTH]
+        # dense integer id given by ReferenceTable when stock is put to a StockRegistry
+        self.stock_id = None
+        # changed by Market on every change of the stock, so that snapshots know which stocks to read again
+        self.version = 0
+        # changed only when reference data changes, results of dividend_yield and pe_ratio depend only on it
+        self.reference_version = 0
         
     def __eq__(self, otherStock):
         # used only in unit test for comparing two instances of Stock class
@@ -29,236 +475,1280 @@ class Stock:
                 self.trade_records[:] == otherStock.trade_records[:])                
         
 
+class ErrorLog:
+    """
+    Logging of Error messages, off until enabled, so that raising Error does no I/O.
+    At most per_second messages are logged every second, the rest are only counted
+    and their number is logged when the next second starts.
+    """
+    def __init__(self):
+        self.logger = logging.getLogger('stock_market')
+        self.enabled = False
+        self.per_second = 10
+        self.second = 0
+        self.logged = 0
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def enable(self, per_second = 10):
+        self.per_second = per_second
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def report(self, message):
+        if not self.enabled:
+            return
+        with self.lock:
+            second = int(time.monotonic())
+            if second != self.second:
+                if self.suppressed:
+                    self.logger.warning("%d more errors were not logged.", self.suppressed)
+                self.second = second
+                self.logged = 0
+                self.suppressed = 0
+            if self.logged < self.per_second:
+                self.logged += 1
+                self.logger.warning(message)
+            else:
+                self.suppressed += 1
+
+
+error_log = ErrorLog()
+"""
+Every Error is reported to it, use error_log.enable() to see them in the log
+"""
+
+
 class Error(Exception):
     def __init__(self, msg):
-        print(msg)
+        Exception.__init__(self, msg)
+        error_log.report(msg)
 
 
-stocks = {}
-""" 
-Dictionary for keeping all Stock instances, so that stocks can be referenced by their name
+class AllShareIndex:
+    """
+    Running sum of logarithms of last traded prices and count of stocks which were traded,
+    so that GBCE All Share Index (geometric mean of those prices) is read in O(1).
+    """
+    def __init__(self):
+        self.log_sum = 0.0
+        self.count = 0
+        # updates since the sum was last computed from scratch
+        self.updates = 0
+
+    def add(self, price):
+        self.log_sum += math.log(price)
+        self.count += 1
+        self.updates += 1
+
+    def remove(self, price):
+        self.log_sum -= math.log(price)
+        self.count -= 1
+        self.updates += 1
+        if self.count == 0:
+            self.reset()
+
+    def replace(self, old_price, new_price):
+        self.log_sum += math.log(new_price) - math.log(old_price)
+        self.updates += 1
+
+    def reset(self, prices = ()):
+        """Compute the sum from scratch for given prices."""
+        logs = [math.log(price) for price in prices]
+        self.log_sum = math.fsum(logs)
+        self.count = len(logs)
+        self.updates = 0
+
+    def value(self):
+        return geometric_mean_of_logs(self.log_sum, self.count)
+
+
+class IndexHistory:
+    """
+    Time series of GBCE All Share Index, sampled at most once per tick nanoseconds as trades
+    are recorded (at every change when tick is 0).
+    Samples are kept in typed arrays, and their lowest and highest values in two segment
+    trees, so the low and high over any period are found in O(log n).
+    """
+    def __init__(self, tick):
+        self.tick = tick
+        self.timestamps = array('q')
+        self.values = array('d')
+        # leaves of the trees start at capacity, every inner node holds min or max of its two children
+        self.capacity = 1
+        self.lows = array('d', [math.inf]) * 2
+        self.highs = array('d', [-math.inf]) * 2
+        # time of the next sample
+        self.next_timestamp = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.values)
+
+    def due(self, timestamp):
+        return self.next_timestamp is None or timestamp >= self.next_timestamp
+
+    def _grow(self):
+        """Double the capacity of the trees and fill them again from values."""
+        capacity = self.capacity = self.capacity * 2
+        self.lows = array('d', [math.inf]) * capacity + self.values + array('d', [math.inf]) * (capacity - len(self.values))
+        self.highs = array('d', [-math.inf]) * capacity + self.values + array('d', [-math.inf]) * (capacity - len(self.values))
+        lows, highs = self.lows, self.highs
+        for node in range(capacity - 1, 0, -1):
+            lows[node] = min(lows[2 * node], lows[2 * node + 1])
+            highs[node] = max(highs[2 * node], highs[2 * node + 1])
+
+    def add(self, timestamp, value):
+        """Add sample taken at timestamp, unless it is older than the newest one or not due yet."""
+        with self.lock:
+            if not self.due(timestamp) or (self.timestamps and timestamp < self.timestamps[-1]):
+                return
+            if self.tick:
+                self.next_timestamp = timestamp - timestamp % self.tick + self.tick
+            self.timestamps.append(timestamp)
+            self.values.append(value)
+            if len(self.values) > self.capacity:
+                self._grow()
+                return
+            node = self.capacity + len(self.values) - 1
+            lows, highs = self.lows, self.highs
+            lows[node] = highs[node] = value
+            node //= 2
+            while node:
+                lows[node] = min(lows[2 * node], lows[2 * node + 1])
+                highs[node] = max(highs[2 * node], highs[2 * node + 1])
+                node //= 2
+
+    def low_high(self, timestamp_from, timestamp_to):
+        """Return lowest and highest sample between two timestamps (both included), None if there are none."""
+        with self.lock:
+            first = bisect_left(self.timestamps, timestamp_from) + self.capacity
+            last = bisect_right(self.timestamps, timestamp_to) + self.capacity
+            if first >= last:
+                return None
+            low, high = math.inf, -math.inf
+            lows, highs = self.lows, self.highs
+            # bottom-up walk over the nodes which cover the leaves first to last - 1
+            while first < last:
+                if first & 1:
+                    low, high = min(low, lows[first]), max(high, highs[first])
+                    first += 1
+                if last & 1:
+                    last -= 1
+                    low, high = min(low, lows[last]), max(high, highs[last])
+                first //= 2
+                last //= 2
+            return low, high
+
+
+class MarketShard:
+    """
+    Part of the market with stocks whose names hash to it.
+    The lock guards those stocks, and index holds their part of GBCE All Share Index.
+    """
+    # after this many index updates, the running sum is computed again from all
+    #    last prices, so that float rounding errors cannot drift away
+    INDEX_RECOMPUTE_INTERVAL = 100000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stocks = {}
+        self.index = AllShareIndex()
+
+    def last_price_changed(self, old_price, new_price):
+        """Update index after a trade changed stock's last price, old_price is None for the first trade."""
+        if old_price is None:
+            self.index.add(new_price)
+        elif old_price != new_price:
+            self.index.replace(old_price, new_price)
+        self.index_updated()
+
+    def index_updated(self):
+        # a sum which is not finite any more would stay NaN or infinite with every later update
+        if self.index.updates >= self.INDEX_RECOMPUTE_INTERVAL or not math.isfinite(self.index.log_sum):
+            self.recompute_index()
+
+    def recompute_index(self):
+        self.index.reset([stock.trade_records.prices[-1] for stock in self.stocks.values() if stock.trade_records])
+
+
+class ReferenceTable:
+    """
+    Reference data of all stocks in parallel typed arrays, indexed by dense integer ids.
+    Stock names are interned to ids once, and an id is kept by the name for good, also when
+    the stock is removed and created again. Removed stocks have stock type 0.
+    Columns are contiguous, so computations over the whole universe can use them through
+    numpy.frombuffer without gathering attributes of Stock instances.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+        # ord('C'), ord('P') or 0 for stocks which are removed
+        self.stock_types = bytearray()
+        self.last_dividends = array('d')
+        self.par_values = array('d')
+        # NaN for common stocks
+        self.fixed_dividends = array('d')
+        # stocks of different shards can be interned at the same time
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, stock_name):
+        """Return id of stock_name, a new one if it was never seen."""
+        stock_id = self.ids.get(stock_name)
+        if stock_id is None:
+            with self.lock:
+                stock_id = self.ids.get(stock_name)
+                if stock_id is None:
+                    stock_id = len(self.names)
+                    self.stock_types.append(0)
+                    self.last_dividends.append(0)
+                    self.par_values.append(0)
+                    self.fixed_dividends.append(math.nan)
+                    self.names.append(stock_name)
+                    self.ids[stock_name] = stock_id
+        return stock_id
+
+    def update(self, stock):
+        """Copy reference data of stock to its row."""
+        stock_id = stock.stock_id
+        self.stock_types[stock_id] = ord(stock.stock_type)
+        self.last_dividends[stock_id] = stock.last_dividend
+        self.par_values[stock_id] = stock.par_value
+        self.fixed_dividends[stock_id] = math.nan if stock.fixed_dividend is None else stock.fixed_dividend
+
+    def remove(self, stock_id):
+        self.stock_types[stock_id] = 0
+
+    def name(self, stock_id):
+        """Return name of the stock with stock_id."""
+        if not 0 <= stock_id < len(self.names):
+            raise Error("Stock id " + str(stock_id) + " is not known.")
+        return self.names[stock_id]
+
+
+class StockRegistry(dict):
+    """
+    Dictionary of Stock instances by their names.
+    Every stock is also put to its MarketShard, whose part of the index is kept up to date
+    when stocks are added or removed, and its reference data to the ReferenceTable.
+    """
+    def __init__(self, shards, versions = None):
+        super().__init__()
+        self.shards = shards
+        self.reference = ReferenceTable()
+        # versions of changes, shared with Market
+        self.versions = count(1) if versions is None else versions
+        # changed with every change of GBCE All Share Index, so that a cached index is not used
+        self.index_version = 0
+
+    def index_changed(self):
+        self.index_version = next(self.versions)
+
+    def shard(self, stock_name):
+        return self.shards[hash(stock_name) % len(self.shards)]
+
+    def __setitem__(self, stock_name, stock):
+        if stock_name in self:
+            del self[stock_name]
+        super().__setitem__(stock_name, stock)
+        stock.stock_id = self.reference.intern(stock_name)
+        self.reference.update(stock)
+        shard = self.shard(stock_name)
+        shard.stocks[stock_name] = stock
+        if stock.trade_records:
+            shard.index.add(stock.trade_records.prices[-1])
+            shard.index_updated()
+            self.index_changed()
+
+    def __delitem__(self, stock_name):
+        stock = self[stock_name]
+        super().__delitem__(stock_name)
+        self.reference.remove(stock.stock_id)
+        shard = self.shard(stock_name)
+        del shard.stocks[stock_name]
+        # cached results of the stock are not valid any more
+        stock.version = stock.reference_version = next(self.versions)
+        if stock.trade_records:
+            shard.index.remove(stock.trade_records.prices[-1])
+            shard.index_updated()
+            self.index_changed()
+
+    def pop(self, stock_name, *default):
+        if stock_name not in self:
+            return super().pop(stock_name, *default)
+        stock = self[stock_name]
+        del self[stock_name]
+        return stock
+
+    def popitem(self):
+        if not self:
+            return super().popitem()
+        # last added stock, as dict.popitem gives
+        stock_name = next(reversed(self))
+        return stock_name, self.pop(stock_name)
+
+    def setdefault(self, stock_name, stock = None):
+        if stock_name not in self:
+            self[stock_name] = stock
+        return self[stock_name]
+
+    def update(self, *args, **kwargs):
+        for stock_name, stock in dict(*args, **kwargs).items():
+            self[stock_name] = stock
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        for stock in self.values():
+            self.reference.remove(stock.stock_id)
+            stock.version = stock.reference_version = next(self.versions)
+        super().clear()
+        for shard in self.shards:
+            shard.stocks.clear()
+            shard.index.reset()
+        self.index_changed()
+
+    def recompute_index(self):
+        for shard in self.shards:
+            shard.recompute_index()
+        self.index_changed()
+
+
+def geometric_mean_of_logs(log_sum, value_count):
+    """Geometric mean of values whose logarithms add up to log_sum, None if there are no values."""
+    if value_count == 0:
+        return None
+    return math.exp(log_sum / value_count)
+
+
+StockState = namedtuple('StockState', 'stock_name stock_type last_dividend par_value fixed_dividend '
+                                       'version last_price prices bars expires')
+StockState.__doc__ = """
+State of one stock in a MarketSnapshot: its reference data, last traded price (None before
+the first trade), and prices and bars, dictionaries of Volume Weighted Stock Price and
+ohlcv_bar by window length in minutes. They are valid until timestamp expires, when the
+oldest trade leaves one of the windows.
 """
 
-def create_stock(stock_name, stock_type, last_dividend, par_value, fixed_dividend = None):
-    try:
-        if stock_name in stocks:
-            raise Error("Stock " + stock_name + " is already created.")
-        
-        if stock_type not in ('C', 'P'):
-            raise Error("Stock type is not properly set.")
-        
-        if last_dividend < 0:
-            raise Error("Last Dividend needs to be non-negative.")
-            
-        if par_value < 0:
-            raise Error("Par Value needs to be non-negative." ) 
-            
-        if stock_type == 'P' and fixed_dividend < 0:
-            raise Error("Fixed Dividend needs to be non-negative.")
-            
-        stocks[stock_name] = Stock(stock_name, stock_type, last_dividend, par_value, fixed_dividend)     
-    
-    except TypeError:
-        raise Error("Please set all arguments correctly.")
-
-
-def remove_stock(stock_name):    
-    if stock_name not in stocks:
-        raise Error("Stock " + stock_name + " is not yet created.")
-        
-    del stocks[stock_name]
 
+class MarketSnapshot:
+    """
+    Point-in-time view of a Market published by Market.snapshot(). It is never changed
+    after it is published, so any number of threads can read it without locks while
+    trades keep being recorded. Functions give the same results as Market's at timestamp,
+    in nanoseconds of the market's clock.
+    """
+    def __init__(self, timestamp, stocks, log_sum, stock_count):
+        self.timestamp = timestamp
+        # StockState by stock name
+        self.stocks = stocks
+        self.log_sum = log_sum
+        self.count = stock_count
 
-def change_stock_type(stock_name, new_stock_type, new_fixed_dividend = None):
-    try:
-        if stock_name not in stocks:
+    def _state(self, stock_name):
+        state = self.stocks.get(stock_name)
+        if state is None:
             raise Error("Stock " + stock_name + " is not yet created.")
-        
-        if new_stock_type not in ('C', 'P'):
-            raise Error("Stock type is not properly set.")        
-            
-        if new_stock_type == 'P' and new_fixed_dividend < 0:
-            raise Error("Fixed Dividend needs to be non-negative.")
-        
-        stock = stocks[stock_name]       
-        
-        stock.stock_type = new_stock_type
-        stock.fixed_dividend = new_fixed_dividend
-    
-    except TypeError:
-        raise Error("Please set all arguments correctly.")   
-        
+        return state
 
-def change_last_dividend(stock_name, new_last_dividend):
-    try:
-        if stock_name not in stocks:
-            raise Error("Stock " + stock_name + " is not yet created.")            
-            
-        if new_last_dividend < 0:
-            raise Error("Last Dividend needs to be non-negative.")
-            
-        stocks[stock_name].last_dividend = new_last_dividend
-    
-    except TypeError:
-        raise Error("Please set all arguments correctly.")           
-
-
-def change_par_value(stock_name, new_par_value):
-    try:
-        if stock_name not in stocks:
-            raise Error("Stock " + stock_name + " is not yet created.")            
-            
-        if new_par_value < 0:
-            raise Error("Par Value needs to be non-negative." ) 
-            
-        stocks[stock_name].par_value = new_par_value
-    
-    except TypeError:
-        raise Error("Please set all arguments correctly.")
-
-
-def change_fixed_dividend(stock_name, new_fixed_dividend):
-    try:
-        if stock_name not in stocks:
-            raise Error("Stock " + stock_name + " is not yet created.")  
-            
-        stock = stocks[stock_name]
-            
-        if stock.stock_type == 'C':
-            raise Error("Stock needs to be of Preferred type.")
-        
-        if new_fixed_dividend < 0:
-            raise Error("Fixed Dividend needs to be non-negative.")
-            
-        stock.fixed_dividend = new_fixed_dividend
-    
-    except TypeError:
-        raise Error("Please set all arguments correctly.")
-        
+    def dividend_yield(self, stock_name, stock_price):
+        try:
+            state = self._state(stock_name)
 
-def dividend_yield(stock_name, stock_price):
-    try:
-        if stock_name not in stocks:
-            raise Error("Stock " + stock_name + " is not yet created.")
-            
-        if stock_price <= 0:
-            raise Error("Stock price needs to be positive.")
-        
-        stock = stocks[stock_name]
-        
-        if stock.stock_type == 'P':
-            return stock.fixed_dividend * stock.par_value / stock_price            
-        else:
-            return stock.last_dividend / stock_price
-            
-    except TypeError:
-        raise Error("Please set all arguments correctly.")
-        
-        
-def pe_ratio(stock_name, stock_price):
-    try:
-        if stock_name not in stocks:
-            raise Error("Stock " + stock_name + " is not yet created.")
-            
-        if stock_price <= 0:
-            raise Error("Stock price needs to be positive.")
-        
-        stock = stocks[stock_name]
-        
-        # This can be changed to be normal output and not an error, but this 
-        #     case was not described in the assignment
-        if stock.last_dividend == 0:
-            raise Error("P/E Ratio cannot be calculated, because stock's Last Dividend is 0.")
-        
-        return stock_price / stock.last_dividend
-            
-    except TypeError:
-        raise Error("Please set all arguments correctly.")       
-        
-        
-def record_trade(stock_name, quantity, buy_sell_ind, stock_price, time_shift = 0):
+            if stock_price <= 0:
+                raise Error("Stock price needs to be positive.")
+
+            if state.stock_type == 'P':
+                return state.fixed_dividend * state.par_value / stock_price
+            else:
+                return state.last_dividend / stock_price
+
+        except TypeError:
+            raise Error("Please set all arguments correctly.")
+
+    def pe_ratio(self, stock_name, stock_price):
+        try:
+            state = self._state(stock_name)
+
+            if stock_price <= 0:
+                raise Error("Stock price needs to be positive.")
+
+            if state.last_dividend == 0:
+                raise Error("P/E Ratio cannot be calculated, because stock's Last Dividend is 0.")
+
+            return stock_price / state.last_dividend
+
+        except TypeError:
+            raise Error("Please set all arguments correctly.")
+
+    def volume_weighted_stock_price(self, stock_name, minutes = VWSP_WINDOW_LENGTH):
+        try:
+            prices = self._state(stock_name).prices
+        except TypeError:
+            return None
+        if minutes not in prices:
+            raise Error("Window of " + str(minutes) + " minutes is not configured.")
+        return prices[minutes]
+
+    def ohlcv_bar(self, stock_name, minutes = VWSP_WINDOW_LENGTH):
+        bars = self._state(stock_name).bars
+        if minutes not in bars:
+            raise Error("Window of " + str(minutes) + " minutes is not configured.")
+        return bars[minutes]
+
+    def index_parts(self):
+        return self.log_sum, self.count
+
+    def gbce_all_share_index(self):
+        index = geometric_mean_of_logs(self.log_sum, self.count)
+        if index is None:
+            raise Error("There are no trade records.")
+
+        return index
+
+
+class ResultCache:
     """
-    Add new entry to stock's trade_records list
+    Results of Market's queries, the least recently used are evicted when there are more
+    than maxsize of them. Every entry is (stock, version, expires, result): it is valid while
+    the version of the stock (or of the index, for GBCE All Share Index) is still the same and
+    the market's time is not after expires, so a cached result is never stale.
+    Single dictionary operations are atomic, so entries are read and written without a lock.
     """
-    try:
-        if stock_name not in stocks:
-            raise Error("Stock " + stock_name + " is not yet created.")
-            
-        if stock_price <= 0:
-            raise Error("Stock price needs to be positive.")
-            
-        if quantity <= 0:
-            raise Error("Quantity needs to be positive.")
-        
-        if buy_sell_ind not in ('B', 'S'):
-            raise Error("Buy or sell indicator is not properly set.")         
-        
-        stock = stocks[stock_name]       
-        
-        # time_shift is used only for testing purposes so that we can easily simulate records through time
-        # timestamp_start is used so that in trade_records we are not dealing with big timestamps
-        timestamp = round(time.time() - stock.timestamp_start - time_shift)
-        
-        stock.trade_records.append((timestamp, quantity, buy_sell_ind, stock_price))
-            
-    except TypeError:
-        raise Error("Please set all arguments correctly.")
-
-def volume_weighted_stock_price(stock_name):
-    try:
-        if stock_name not in stocks:
-            raise Error("Stock " + stock_name + " is not yet created.")
-   
-        stock = stocks[stock_name]       
-        
-        # specified in minutes
-        window_length = 15        
-        
-        # used as a boundary, so that only stocks with timestamps greater or 
-        #    equal to this are taken into account
-        boundary_timestamp = round(time.time() - window_length * 60 - stock.timestamp_start)
-        
-        quantity_sum = 0
-        quantity_price_sum = 0
-        result = 0
-        # calculations start with latest trades down until trades around boundary_timestamp
-        for record in reversed(stock.trade_records):
-            if record[0] < boundary_timestamp:
-                break
-            # record[1] is quantity and and record[3] is price 
-            quantity_sum += record[1]
-            quantity_price_sum += record[1]*record[3]
-        
-        if quantity_sum > 0:
-            result = quantity_price_sum / quantity_sum
-            
-        return result   
-    except TypeError:
-        pass
+    def __init__(self, maxsize = 4096):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            try:
+                self.entries.move_to_end(key)
+            except KeyError:
+                # evicted by another thread in the meantime
+                pass
+        return entry
+
+    def put(self, key, entry):
+        entries = self.entries
+        entries[key] = entry
+        if len(entries) > self.maxsize:
+            try:
+                entries.popitem(last=False)
+            except KeyError:
+                pass
+
 
-def gbce_all_share_index():
+class Market:
     """
-    Return GBCE All Share Index using the geometric mean of prices for all stocks
-    Last traded prices are used.
-    Stocks which do not have trade records are ecluded from calculations.     
+    All stocks together with the operations on them.
+    Stocks are split to shards by their names, and every operation on a stock holds only
+    its shard's lock, so that trades of stocks in different shards are recorded in parallel.
+    Readers of GBCE All Share Index hold all shard locks, so they see a consistent state.
     """
-    try:        
-        excluded_stocks = []
-        prices = []
-        for stock in stocks.values():
-            if len(stock.trade_records) > 0:
-                # last traded price is used
-                prices.append(stock.trade_records[-1][3])
-            else:
-                # excluded_stocks is not later used, but can be used for info 
-                #   about stocks which are not taken into account
-                excluded_stocks.append(stock.stock_name)
-        if len(prices) == 0:
+    def __init__(self, shard_count = 16, retention = None, resolutions = BAR_RESOLUTIONS, clock = None,
+                 index_tick = None, cache_size = None):
+        self.shards = [MarketShard() for _ in range(shard_count)]
+        # versions given to stocks and to the index when they change, never the same for two changes
+        self.versions = count(1)
+        self.stocks = StockRegistry(self.shards, self.versions)
+        # TradeJournal from journal.py, if trades need to be persisted
+        self.journal = None
+        # RetentionPolicy, if old trades should not be kept forever
+        self.retention = retention
+        # window lengths in minutes for which VWSP and OHLCV bars of every stock are kept
+        self.resolutions = resolutions
+        # Clock from clock.py shared by all stocks, a SimulatedClock when trades are replayed
+        self.clock = SystemClock() if clock is None else clock
+        # numbers of rejected trades, indexed by rejection code
+        self.rejections = array('q', [0]) * (len(REJECTION_MESSAGES) + 1)
+        self.rejections_lock = threading.Lock()
+        # last MarketSnapshot published by snapshot()
+        self.published = None
+        # samples of GBCE All Share Index taken every index_tick seconds, if it is given
+        self.index_history = None if index_tick is None else IndexHistory(to_nanoseconds(index_tick))
+        # results of queries, when cache_size is given
+        self.cache = None if cache_size is None else ResultCache(cache_size)
+
+    def create_stock(self, stock_name, stock_type, last_dividend, par_value, fixed_dividend = None):
+        try:
+            with self.stocks.shard(stock_name).lock:
+                if stock_name in self.stocks:
+                    raise Error("Stock " + stock_name + " is already created.")
+
+                if stock_type not in ('C', 'P'):
+                    raise Error("Stock type is not properly set.")
+
+                if last_dividend < 0:
+                    raise Error("Last Dividend needs to be non-negative.")
+
+                if par_value < 0:
+                    raise Error("Par Value needs to be non-negative." )
+
+                if stock_type == 'P' and fixed_dividend < 0:
+                    raise Error("Fixed Dividend needs to be non-negative.")
+
+                stock = Stock(stock_name, stock_type, last_dividend, par_value, fixed_dividend,
+                              self.resolutions, self.clock.epoch_ns)
+                stock.version = stock.reference_version = next(self.versions)
+                self.stocks[stock_name] = stock
+
+        except TypeError:
+            raise Error("Please set all arguments correctly.")
+
+    def remove_stock(self, stock_name):
+        with self.stocks.shard(stock_name).lock:
+            if stock_name not in self.stocks:
+                raise Error("Stock " + stock_name + " is not yet created.")
+
+            del self.stocks[stock_name]
+
+    def change_stock_type(self, stock_name, new_stock_type, new_fixed_dividend = None):
+        try:
+            with self.stocks.shard(stock_name).lock:
+                if stock_name not in self.stocks:
+                    raise Error("Stock " + stock_name + " is not yet created.")
+
+                if new_stock_type not in ('C', 'P'):
+                    raise Error("Stock type is not properly set.")
+
+                if new_stock_type == 'P' and new_fixed_dividend < 0:
+                    raise Error("Fixed Dividend needs to be non-negative.")
+
+                stock = self.stocks[stock_name]
+
+                stock.stock_type = new_stock_type
+                stock.fixed_dividend = new_fixed_dividend
+                self.stocks.reference.update(stock)
+                stock.version = stock.reference_version = next(self.versions)
+
+        except TypeError:
+            raise Error("Please set all arguments correctly.")
+
+    def change_last_dividend(self, stock_name, new_last_dividend):
+        try:
+            with self.stocks.shard(stock_name).lock:
+                if stock_name not in self.stocks:
+                    raise Error("Stock " + stock_name + " is not yet created.")
+
+                if new_last_dividend < 0:
+                    raise Error("Last Dividend needs to be non-negative.")
+
+                stock = self.stocks[stock_name]
+                stock.last_dividend = new_last_dividend
+                self.stocks.reference.update(stock)
+                stock.version = stock.reference_version = next(self.versions)
+
+        except TypeError:
+            raise Error("Please set all arguments correctly.")
+
+    def change_par_value(self, stock_name, new_par_value):
+        try:
+            with self.stocks.shard(stock_name).lock:
+                if stock_name not in self.stocks:
+                    raise Error("Stock " + stock_name + " is not yet created.")
+
+                if new_par_value < 0:
+                    raise Error("Par Value needs to be non-negative." )
+
+                stock = self.stocks[stock_name]
+                stock.par_value = new_par_value
+                self.stocks.reference.update(stock)
+                stock.version = stock.reference_version = next(self.versions)
+
+        except TypeError:
+            raise Error("Please set all arguments correctly.")
+
+    def change_fixed_dividend(self, stock_name, new_fixed_dividend):
+        try:
+            with self.stocks.shard(stock_name).lock:
+                if stock_name not in self.stocks:
+                    raise Error("Stock " + stock_name + " is not yet created.")
+
+                stock = self.stocks[stock_name]
+
+                if stock.stock_type == 'C':
+                    raise Error("Stock needs to be of Preferred type.")
+
+                if new_fixed_dividend < 0:
+                    raise Error("Fixed Dividend needs to be non-negative.")
+
+                stock.fixed_dividend = new_fixed_dividend
+                self.stocks.reference.update(stock)
+                stock.version = stock.reference_version = next(self.versions)
+
+        except TypeError:
+            raise Error("Please set all arguments correctly.")
+
+    def dividend_yield(self, stock_name, stock_price):
+        # stock can also be given by its id from stock_id, on this and other hot paths
+        if stock_name.__class__ is int:
+            stock_name = self.stocks.reference.name(stock_name)
+        try:
+            cache = self.cache
+            if cache is not None:
+                key = ('dividend_yield', stock_name, stock_price)
+                entry = cache.get(key)
+                if entry is not None and entry[0].reference_version == entry[1]:
+                    return entry[3]
+
+            with self.stocks.shard(stock_name).lock:
+                if stock_name not in self.stocks:
+                    raise Error("Stock " + stock_name + " is not yet created.")
+
+                if stock_price <= 0:
+                    raise Error("Stock price needs to be positive.")
+
+                stock = self.stocks[stock_name]
+
+                if stock.stock_type == 'P':
+                    result = stock.fixed_dividend * stock.par_value / stock_price
+                else:
+                    result = stock.last_dividend / stock_price
+
+                if cache is not None:
+                    cache.put(key, (stock, stock.reference_version, None, result))
+                return result
+
+        except TypeError:
+            raise Error("Please set all arguments correctly.")
+
+    def pe_ratio(self, stock_name, stock_price):
+        if stock_name.__class__ is int:
+            stock_name = self.stocks.reference.name(stock_name)
+        try:
+            cache = self.cache
+            if cache is not None:
+                key = ('pe_ratio', stock_name, stock_price)
+                entry = cache.get(key)
+                if entry is not None and entry[0].reference_version == entry[1]:
+                    return entry[3]
+
+            with self.stocks.shard(stock_name).lock:
+                if stock_name not in self.stocks:
+                    raise Error("Stock " + stock_name + " is not yet created.")
+
+                if stock_price <= 0:
+                    raise Error("Stock price needs to be positive.")
+
+                stock = self.stocks[stock_name]
+
+                # This can be changed to be normal output and not an error, but this
+                #     case was not described in the assignment
+                if stock.last_dividend == 0:
+                    raise Error("P/E Ratio cannot be calculated, because stock's Last Dividend is 0.")
+
+                result = stock_price / stock.last_dividend
+                if cache is not None:
+                    cache.put(key, (stock, stock.reference_version, None, result))
+                return result
+
+        except TypeError:
+            raise Error("Please set all arguments correctly.")
+
+    def stock_id(self, stock_name):
+        """Return integer id of a created stock, which hot paths take instead of its name."""
+        with self.stocks.shard(stock_name).lock:
+            if stock_name not in self.stocks:
+                raise Error("Stock " + stock_name + " is not yet created.")
+
+            return self.stocks[stock_name].stock_id
+
+    def _dividends(self, stocks):
+        """
+        Return NumPy arrays of the dividends used for dividend yield (Fixed Dividend * Par Value
+        for preferred stocks) and of Last Dividends of stocks, given by names or ids, NaN for
+        stocks which are not created. Rows are taken from the columns of the ReferenceTable.
+        """
+        import numpy
+
+        reference = self.stocks.reference
+        ids = numpy.asarray(stocks)
+        if ids.dtype.kind not in 'iu':
+            ids = numpy.fromiter((reference.ids.get(stock_name, -1) for stock_name in stocks),
+                                 dtype=numpy.intp, count=len(stocks))
+
+        with self.all_shards_locked():
+            stock_count = len(reference)
+            known = (ids >= 0) & (ids < stock_count)
+            if not stock_count:
+                return numpy.full(len(ids), numpy.nan), numpy.full(len(ids), numpy.nan)
+            rows = numpy.where(known, ids, 0)
+            # views of the columns are dropped right after indexing, while the table cannot grow
+            stock_types = numpy.frombuffer(reference.stock_types, dtype=numpy.uint8)[rows]
+            last_dividends = numpy.frombuffer(reference.last_dividends)[rows]
+            par_values = numpy.frombuffer(reference.par_values)[rows]
+            fixed_dividends = numpy.frombuffer(reference.fixed_dividends)[rows]
+
+        dividends = numpy.where(stock_types == ord('P'), fixed_dividends * par_values, last_dividends)
+        missing = ~known | (stock_types == 0)
+        dividends[missing] = numpy.nan
+        last_dividends[missing] = numpy.nan
+        return dividends, last_dividends
+
+    def _prices_column(self, stock_names, stock_prices):
+        import numpy
+
+        stock_prices = numpy.asarray(stock_prices, dtype=float)
+        if stock_prices.shape != (len(stock_names),):
+            raise Error("Columns need to be of the same length.")
+        return stock_prices
+
+    def dividend_yields(self, stock_names, stock_prices):
+        """
+        Dividend yields of many stocks, given by names or ids, at once, as a NumPy array.
+        Instead of raising Error, NaN is returned for stocks which are not created
+        and for prices which are not positive.
+        """
+        import numpy
+
+        try:
+            stock_prices = self._prices_column(stock_names, stock_prices)
+            dividends = self._dividends(stock_names)[0]
+        except (TypeError, ValueError):
+            raise Error("Please set all arguments correctly.")
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return numpy.where(stock_prices > 0, dividends / stock_prices, numpy.nan)
+
+    def pe_ratios(self, stock_names, stock_prices):
+        """
+        P/E ratios of many stocks, given by names or ids, at once, as a NumPy array.
+        Instead of raising Error, NaN is returned for stocks which are not created,
+        for prices which are not positive and for stocks whose Last Dividend is 0.
+        """
+        import numpy
+
+        try:
+            stock_prices = self._prices_column(stock_names, stock_prices)
+            last_dividends = self._dividends(stock_names)[1]
+        except (TypeError, ValueError):
+            raise Error("Please set all arguments correctly.")
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return numpy.where((stock_prices > 0) & (last_dividends != 0), stock_prices / last_dividends, numpy.nan)
+
+    def _trade_code(self, stock_name, quantity, buy_sell_ind, stock_price):
+        """
+        Return the code of the reason why trade cannot be recorded, or RECORDED if it is valid
+        """
+        if stock_name not in self.stocks:
+            return STOCK_NOT_CREATED if isinstance(stock_name, str) else ARGUMENTS_NOT_SET
+
+        # written so that NaN is rejected too, and infinity, which would break the sums and the index for good
+        if not 0 < stock_price < math.inf:
+            return PRICE_NOT_POSITIVE
+
+        if not 0 < quantity < math.inf:
+            return QUANTITY_NOT_POSITIVE
+
+        if buy_sell_ind not in ('B', 'S'):
+            return SIDE_NOT_SET
+
+        return RECORDED
+
+    def _count_rejections(self, codes):
+        """Add counts of rejections by code, given as a list indexed by code."""
+        with self.rejections_lock:
+            for code, number in enumerate(codes):
+                self.rejections[code] += number
+
+    def rejection_counts(self):
+        """Return dictionary of numbers of rejected trades by rejection code."""
+        with self.rejections_lock:
+            return {code: number for code, number in enumerate(self.rejections) if number}
+
+    def _add_trades(self, stock, timestamps, quantities, sides, stock_prices):
+        """
+        Put validated trades, given as columns like in TradeStore, to stock's trade_records.
+        Caller needs to hold the lock of stock's shard.
+        """
+        if any(map(int.__gt__, timestamps, timestamps[1:])):
+            # stable sort, so that trades with equal timestamps keep their order
+            order = sorted(range(len(timestamps)), key=timestamps.__getitem__)
+            timestamps = array('q', [timestamps[index] for index in order])
+            quantities = array('d', [quantities[index] for index in order])
+            sides = bytes([sides[index] for index in order])
+            stock_prices = array('d', [stock_prices[index] for index in order])
+
+        records = stock.trade_records
+        last_price = records.prices[-1] if records else None
+        if records.extend(timestamps, quantities, sides, stock_prices):
+            stock.bars.add_many(timestamps, quantities, stock_prices)
+        else:
+            # batch contains trades older than the ones already recorded, each of them goes to its place
+            stock.bars.evict(self.clock.now())
+            for timestamp, quantity, side, stock_price in zip(timestamps, quantities, sides, stock_prices):
+                position = records.insert(timestamp, quantity, chr(side), stock_price)
+                stock.bars.add(position, quantity, stock_price)
+
+        stock.version = next(self.versions)
+        if records:
+            self.stocks.shard(stock.stock_name).last_price_changed(last_price, records.prices[-1])
+            self.stocks.index_changed()
+
+    def _retain(self, stock, now):
+        """
+        Drop stock's trades which retention policy does not keep at time now, as in trade_records.
+        Caller needs to hold the lock of stock's shard.
+        """
+        records = stock.trade_records
+        # windows are moved forward first, otherwise trades which already left them would be kept
+        head = stock.bars.evict(now)
+        drop_count = min(self.retention.droppable(records, now), head, len(records) - 1)
+        if drop_count < max(RetentionPolicy.MIN_DROP, (len(records) - drop_count) // 8):
+            return
+
+        dropped = records.drop_oldest(drop_count)
+        stock.bars.drop_oldest(drop_count)
+        if self.retention.spill is not None:
+            self.retention.spill(stock, *dropped)
+
+    def record_trade(self, stock_name, quantity, buy_sell_ind, stock_price, time_shift = 0):
+        """
+        Add new entry to stock's trade_records, which are kept ordered by timestamp
+        """
+        if stock_name.__class__ is int:
+            stock_name = self.stocks.reference.name(stock_name)
+        code = self._try_record_trade(stock_name, quantity, buy_sell_ind, stock_price, time_shift)
+        if code:
+            raise Error(rejection_message(code, stock_name))
+
+    def try_record_trade(self, stock_name, quantity, buy_sell_ind, stock_price, time_shift = 0):
+        """
+        Fast validation mode of record_trade: RECORDED is returned, or the code of the reason
+        why trade was rejected, so that rejections raise no exception and do no I/O.
+        Rejections are counted in rejection_counts().
+        """
+        if stock_name.__class__ is int:
+            names = self.stocks.reference.names
+            stock_name = names[stock_name] if 0 <= stock_name < len(names) else None
+        try:
+            shard = self.stocks.shard(stock_name)
+        except TypeError:
+            # name which cannot be hashed is rejected by _trade_code, under any lock
+            shard = self.shards[0]
+        with shard.lock:
+            try:
+                code = self._record_trade(shard, stock_name, quantity, buy_sell_ind, stock_price, time_shift)
+            # NaN time_shift gives ValueError, infinite or too big one OverflowError
+            except (TypeError, ValueError, OverflowError):
+                code = ARGUMENTS_NOT_SET
+        if code:
+            with self.rejections_lock:
+                self.rejections[code] += 1
+        elif self.index_history is not None:
+            self._sample_index()
+        return code
+
+    # other functions call it under this name, so that when metrics.py wraps the public one
+    #    the calls are not counted twice
+    _try_record_trade = try_record_trade
+
+    def _record_trade(self, shard, stock_name, quantity, buy_sell_ind, stock_price, time_shift):
+        """Validate and record one trade, caller needs to hold the lock of its shard."""
+        code = self._trade_code(stock_name, quantity, buy_sell_ind, stock_price)
+        if code:
+            return code
+
+        stock = self.stocks[stock_name]
+
+        # time_shift is used only for testing purposes so that we can easily simulate records through time
+        now = self.clock.now()
+        timestamp = now - to_nanoseconds(time_shift)
+        # timestamp which does not fit the columns raises OverflowError when it is appended to the journal or
+        #    inserted to trade_records, both put it before anything else of the trade
+
+        if self.journal is not None:
+            self.journal.append(stock, timestamp, quantity, buy_sell_ind, stock_price)
+
+        records = stock.trade_records
+        last_price = records.prices[-1] if records else None
+        if records and timestamp < records.timestamps[-1]:
+            # windows are moved to now first, so that a late trade older than a window leaves it untouched
+            stock.bars.evict(now)
+        position = records.insert(timestamp, quantity, buy_sell_ind, stock_price)
+        stock.bars.add(position, quantity, stock_price)
+        stock.version = next(self.versions)
+
+        # only the newest trade changes the price used in GBCE All Share Index
+        if position == len(records) - 1:
+            shard.last_price_changed(last_price, records.prices[-1])
+            self.stocks.index_changed()
+
+        if self.retention is not None:
+            self._retain(stock, now)
+        return RECORDED
+
+    def record_trades(self, trades, result_codes = False):
+        """
+        Record many trades at once.
+        trades is an iterable of (stock_name, quantity, buy_sell_ind, stock_price) rows,
+        time_shift can be given as the fifth item of a row.
+        Rows which are not valid are skipped, and list of (row_number, message) for them is returned,
+        or of (row_number, code) with result_codes, as returned by try_record_trade.
+        Trades of a stock which is removed while they are being recorded are dropped.
+        """
+        self.clock.refresh()
+        now = self.clock.now()
+        rejected = []
+        # for every stock, columns of its valid trades
+        batches = {}
+        for row_number, row in enumerate(trades):
+            try:
+                stock_name, quantity, buy_sell_ind, stock_price = row[:4]
+                time_shift = row[4] if len(row) > 4 else 0
+
+                batch = batches.get(stock_name)
+                if batch is None:
+                    code = self._trade_code(stock_name, quantity, buy_sell_ind, stock_price)
+                    # no shard lock is held here, the stock can be removed right after it was checked
+                    stock = self.stocks.get(stock_name)
+                    if stock is None and not code:
+                        code = STOCK_NOT_CREATED
+                    if code:
+                        rejected.append((row_number, code, stock_name))
+                        continue
+                    batch = batches[stock_name] = (stock, array('q'), array('d'), bytearray(), array('d'))
+                # same checks as in _trade_code, written out because this is the hot loop
+                elif not (0 < stock_price < math.inf and 0 < quantity < math.inf and buy_sell_ind in ('B', 'S')):
+                    rejected.append((row_number, self._trade_code(stock_name, quantity, buy_sell_ind, stock_price),
+                                     stock_name))
+                    continue
+
+                timestamp = now - to_nanoseconds(time_shift) if time_shift else now
+                quantity = float(quantity)
+                stock_price = float(stock_price)
+                # first of the columns, so that a timestamp out of its range rejects the row before anything is added
+                batch[1].append(timestamp)
+            # NaN time_shift gives ValueError, infinite or too big one OverflowError
+            except (TypeError, ValueError, OverflowError):
+                rejected.append((row_number, ARGUMENTS_NOT_SET, None))
+                continue
+
+            batch[2].append(quantity)
+            batch[3].append(ord(buy_sell_ind))
+            batch[4].append(stock_price)
+
+        for stock_name, batch in batches.items():
+            stock = batch[0]
+            with self.stocks.shard(stock_name).lock:
+                if self.stocks.get(stock_name) is stock:
+                    if self.journal is not None:
+                        self.journal.extend(stock, *batch[1:])
+                    self._add_trades(stock, *batch[1:])
+                    if self.retention is not None:
+                        self._retain(stock, now)
+
+        if self.index_history is not None and batches:
+            self._sample_index()
+
+        if not rejected:
+            return rejected
+        codes = [0] * len(self.rejections)
+        for _, code, _ in rejected:
+            codes[code] += 1
+        self._count_rejections(codes)
+        if result_codes:
+            return [(row_number, code) for row_number, code, _ in rejected]
+        return [(row_number, rejection_message(code, stock_name)) for row_number, code, stock_name in rejected]
+
+    _record_trades = record_trades
+
+    def record_trade_columns(self, stock_name, quantities, buy_sell_inds, stock_prices, time_shifts = None):
+        """
+        Record many trades of one stock given as parallel columns (lists, arrays or NumPy arrays),
+        buy_sell_inds can also be a string like 'BSSB'.
+        Each column is validated in one pass. Only if that finds a problem, rows are checked
+        one by one and list of (row_number, message) for rejected rows is returned.
+        """
+        try:
+            if stock_name not in self.stocks:
+                raise Error("Stock " + stock_name + " is not yet created.")
+
+            row_count = len(quantities)
+            if (len(buy_sell_inds) != row_count or len(stock_prices) != row_count or
+                    (time_shifts is not None and len(time_shifts) != row_count)):
+                raise Error("Columns need to be of the same length.")
+
+            if row_count == 0:
+                return []
+
+            try:
+                valid = (_all_positive(stock_prices) and _all_positive(quantities) and
+                         set(buy_sell_inds) <= {'B', 'S'})
+                if valid and time_shifts is not None:
+                    shifts = array('q', map(to_nanoseconds, time_shifts))
+            except (TypeError, ValueError, OverflowError):
+                valid = False
+
+            if not valid:
+                if time_shifts is None:
+                    time_shifts = repeat(0)
+                return self._record_trades(zip(repeat(stock_name), quantities, buy_sell_inds, stock_prices, time_shifts))
+
+            quantities = array('d', quantities)
+            sides = ''.join(buy_sell_inds).encode('ascii')
+            stock_prices = array('d', stock_prices)
+
+            with self.stocks.shard(stock_name).lock:
+                if stock_name not in self.stocks:
+                    raise Error("Stock " + stock_name + " is not yet created.")
+
+                stock = self.stocks[stock_name]
+                # time_shift is used in the same way as in record_trade
+                self.clock.refresh()
+                now = self.clock.now()
+                if time_shifts is None:
+                    timestamps = array('q', [now]) * row_count
+                else:
+                    timestamps = array('q', [now - shift for shift in shifts])
+
+                if self.journal is not None:
+                    self.journal.extend(stock, timestamps, quantities, sides, stock_prices)
+                self._add_trades(stock, timestamps, quantities, sides, stock_prices)
+                if self.retention is not None:
+                    self._retain(stock, now)
+            if self.index_history is not None:
+                self._sample_index()
+            return []
+
+        except TypeError:
+            raise Error("Please set all arguments correctly.")
+
+    def volume_weighted_stock_price(self, stock_name, minutes = VWSP_WINDOW_LENGTH):
+        """Volume Weighted Stock Price of trades in the last given minutes, one of the configured resolutions."""
+        if stock_name.__class__ is int:
+            stock_name = self.stocks.reference.name(stock_name)
+        try:
+            cache = self.cache
+            if cache is not None:
+                key = ('volume_weighted_stock_price', stock_name, minutes)
+                entry = cache.get(key)
+                if entry is not None and entry[0].version == entry[1] and self.clock.now() <= entry[2]:
+                    return entry[3]
+
+            with self.stocks.shard(stock_name).lock:
+                if stock_name not in self.stocks:
+                    raise Error("Stock " + stock_name + " is not yet created.")
+
+                stock = self.stocks[stock_name]
+                window = stock.bars.window(minutes)
+
+                # used as a boundary, so that only stocks with timestamps greater or
+                #    equal to this are taken into account
+                boundary_timestamp = self.clock.now() - window.window_length
+
+                # expired trades are evicted from the running sums instead of summing the whole window again
+                result = window.price(boundary_timestamp)
+
+                if cache is not None:
+                    # result changes next when the oldest trade in the window leaves it
+                    records = stock.trade_records
+                    expires = (records.timestamps[window.head] + window.window_length if window.head < len(records)
+                               else math.inf)
+                    cache.put(key, (stock, stock.version, expires, result))
+                return result
+        except TypeError:
+            pass
+
+    def ohlcv_bar(self, stock_name, minutes = VWSP_WINDOW_LENGTH):
+        """
+        Return (open, high, low, close, volume) of trades in the last given minutes, one of
+        the configured resolutions, or None if there were no trades.
+        """
+        if stock_name.__class__ is int:
+            stock_name = self.stocks.reference.name(stock_name)
+        with self.stocks.shard(stock_name).lock:
+            if stock_name not in self.stocks:
+                raise Error("Stock " + stock_name + " is not yet created.")
+
+            stock = self.stocks[stock_name]
+            window = stock.bars.window(minutes)
+            return window.bar(self.clock.now() - window.window_length)
+
+    def volume_weighted_stock_price_between(self, stock_name, time_from, time_to):
+        """
+        Return Volume Weighted Stock Price of trades recorded between time_from and time_to
+        (both included), given in seconds since the epoch like time.time().
+        Window boundaries are found by binary search in the ordered trade_records.
+        """
+        try:
+            with self.stocks.shard(stock_name).lock:
+                if stock_name not in self.stocks:
+                    raise Error("Stock " + stock_name + " is not yet created.")
+
+                if time_from > time_to:
+                    raise Error("Start of the period needs to be before its end.")
+
+                stock = self.stocks[stock_name]
+
+                return stock.trade_records.volume_weighted_price(self.clock.timestamp(time_from),
+                                                                 self.clock.timestamp(time_to))
+        except TypeError:
+            raise Error("Please set all arguments correctly.")
+
+    def _sample_index(self):
+        """Add GBCE All Share Index to index_history if a sample is due, caller must not hold any shard lock."""
+        if not self.index_history.due(self.clock.now()):
+            return
+        with self.all_shards_locked():
+            # read under the locks, so that samples are in time order
+            now = self.clock.now()
+            index = geometric_mean_of_logs(*self._index_sums())
+            if index is not None:
+                self.index_history.add(now, index)
+
+    def gbce_all_share_index_low_high(self, time_from, time_to):
+        """
+        Return lowest and highest GBCE All Share Index sampled between time_from and time_to
+        (both included), given in seconds since the epoch like time.time().
+        Market needs to be created with index_tick.
+        """
+        if self.index_history is None:
+            raise Error("Index history is not kept, market needs to be created with index_tick.")
+        try:
+            if time_from > time_to:
+                raise Error("Start of the period needs to be before its end.")
+
+            low_high = self.index_history.low_high(self.clock.timestamp(time_from), self.clock.timestamp(time_to))
+        except TypeError:
+            raise Error("Please set all arguments correctly.")
+        if low_high is None:
+            raise Error("There are no index samples in the period.")
+        return low_high
+
+    @contextmanager
+    def all_shards_locked(self):
+        """Hold locks of all shards, so that the whole market is read in a consistent state."""
+        for shard in self.shards:
+            shard.lock.acquire()
+        try:
+            yield
+        finally:
+            for shard in self.shards:
+                shard.lock.release()
+
+    def _index_sums(self):
+        """Sum of logarithms of last traded prices and number of traded stocks, caller needs to hold all shard locks."""
+        return (sum(shard.index.log_sum for shard in self.shards),
+                sum(shard.index.count for shard in self.shards))
+
+    def index_parts(self):
+        """
+        Return sum of logarithms of last traded prices and number of traded stocks,
+        read from all shards while all of them are locked.
+        """
+        with self.all_shards_locked():
+            return self._index_sums()
+
+    def _stock_state(self, stock, now):
+        """Read StockState of stock at time now, caller needs to hold the lock of its shard."""
+        records = stock.trade_records
+        prices = {}
+        bars = {}
+        expires = math.inf
+        for minutes, window in stock.bars.windows.items():
+            boundary_timestamp = now - window.window_length
+            bars[minutes] = window.bar(boundary_timestamp)
+            prices[minutes] = window.price(boundary_timestamp)
+            if window.head < len(records):
+                expires = min(expires, records.timestamps[window.head] + window.window_length)
+        return StockState(stock.stock_name, stock.stock_type, stock.last_dividend, stock.par_value,
+                          stock.fixed_dividend, stock.version, records.prices[-1] if records else None,
+                          prices, bars, expires)
+
+    def snapshot(self):
+        """
+        Publish a MarketSnapshot of the current state and return it, it is also kept in published.
+        Trade histories are not copied: the snapshot keeps a small StockState of every stock,
+        and states of stocks whose version did not change and whose windows did not move
+        are taken over from the previous snapshot, so only changed stocks are read.
+        """
+        with self.all_shards_locked():
+            previous = {} if self.published is None else self.published.stocks
+            now = self.clock.now()
+            states = {}
+            for stock_name, stock in self.stocks.items():
+                state = previous.get(stock_name)
+                if state is None or state.version != stock.version or state.expires < now:
+                    state = self._stock_state(stock, now)
+                states[stock_name] = state
+            self.published = MarketSnapshot(now, states, *self._index_sums())
+            return self.published
+
+    def gbce_all_share_index(self):
+        """
+        Return GBCE All Share Index using the geometric mean of prices for all stocks
+        Last traded prices are used.
+        Stocks which do not have trade records are ecluded from calculations.
+        Every shard keeps its part of the index up to date, so reading it does not depend
+        on the number of stocks.
+        """
+        cache = self.cache
+        if cache is None:
+            index = geometric_mean_of_logs(*self.index_parts())
+        else:
+            entry = cache.get('gbce_all_share_index')
+            if entry is not None and entry[1] == self.stocks.index_version:
+                return entry[3]
+            with self.all_shards_locked():
+                version = self.stocks.index_version
+                index = geometric_mean_of_logs(*self._index_sums())
+            if index is not None:
+                cache.put('gbce_all_share_index', (None, version, None, index))
+        if index is None:
             raise Error("There are no trade records.")
-        
-        return gmean(prices)
-    except TypeError:
-        pass
-         
 
-        
\ No newline at end of file
+        return index
+
+
+def _all_positive(values):
+    """Whether all values of a column are positive and finite, as _trade_code checks them."""
+    # NumPy arrays compute their minimum and maximum without a Python level loop, NaN in them is both
+    if hasattr(values, 'min'):
+        return bool(values.min() > 0 and values.max() < math.inf)
+    # min() skips NaN which is not first, but the sum is NaN or infinite with NaN or infinity in any place
+    return 0 < sum(values) < math.inf and min(values) > 0
+
+
+market = Market()
+"""
+Market used by the module level functions below
+"""
+
+stocks = market.stocks
+"""
+Dictionary for keeping all Stock instances, so that stocks can be referenced by their name
+"""
+
+create_stock = market.create_stock
+remove_stock = market.remove_stock
+change_stock_type = market.change_stock_type
+change_last_dividend = market.change_last_dividend
+change_par_value = market.change_par_value
+change_fixed_dividend = market.change_fixed_dividend
+dividend_yield = market.dividend_yield
+pe_ratio = market.pe_ratio
+dividend_yields = market.dividend_yields
+pe_ratios = market.pe_ratios
+stock_id = market.stock_id
+record_trade = market.record_trade
+record_trades = market.record_trades
+record_trade_columns = market.record_trade_columns
+volume_weighted_stock_price = market.volume_weighted_stock_price
+ohlcv_bar = market.ohlcv_bar
+volume_weighted_stock_price_between = market.volume_weighted_stock_price_between
+gbce_all_share_index = market.gbce_all_share_index
+gbce_all_share_index_low_high = market.gbce_all_share_index_low_high
+snapshot = market.snapshot
@@ -1,10 +1,50 @@
 # -*- coding: utf-8 -*-
 
 from stock_market import *
+from clock import NANOSECONDS, SimulatedClock, SystemClock, CoarseClock
+from sharded_engine import ShardedEngine
+from journal import TradeJournal, load_journal
+from server import start_server
+from replay import read_csv, read_journal_trades, read_parquet, replay
+from metrics import LatencyHistogram, Metrics
+from order_book import MatchingEngine
 import unittest
+import threading
+import contextlib
+import io
+import urllib.request
+import random
+from array import array
+import time
+import os
+import tempfile
+import asyncio
 from scipy.stats.mstats import gmean
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+def in_seconds(records):
+    """Trades with timestamps converted to seconds, as time shifts are given in the tests."""
+    return [(timestamp / NANOSECONDS,) + tuple(record) for timestamp, *record in records]
+
+
 class MyTest(unittest.TestCase):
+    def setUp(self):
+        # time stands still, so that timestamps of recorded trades are known exactly
+        self.real_clock = market.clock
+        market.clock = SimulatedClock(market.clock.epoch_ns)
+        
+    def tearDown(self):
+        market.clock = self.real_clock
+        
     def test_creating_stock(self):
         self.assertTrue(stocks == {})
         self.assertEqual(create_stock('TEA', 'C', 0, 100), None)
@@ -175,10 +215,10 @@ class MyTest(unittest.TestCase):
         self.assertEqual(record_trade('TEA', 18, 'B', 130, -1), None)
         self.assertEqual(record_trade('GIN', 10, 'B', 70, -2), None)
         
-        self.assertEqual(stocks['TEA'].trade_records, [(-1, 5, 'B', 135),
+        self.assertEqual(in_seconds(stocks['TEA'].trade_records), [(-1, 5, 'B', 135),
                                (0, 15, 'S', 120), (1, 18, 'B', 130)])
 
-        self.assertEqual(stocks['GIN'].trade_records, [(0, 20, 'S', 56), (2, 10, 'B', 70)])
+        self.assertEqual(in_seconds(stocks['GIN'].trade_records), [(0, 20, 'S', 56), (2, 10, 'B', 70)])
 
         with self.assertRaises(Error, msg= "Stock price needs to be positive."):
             record_trade('TEA', 15, 'S', -120)    
@@ -203,6 +243,69 @@ class MyTest(unittest.TestCase):
                                
         stocks.clear()
         
+    def test_recording_many_trades(self):
+        self.assertEqual(create_stock('TEA', 'C', 5, 100), None)
+        self.assertEqual(create_stock('GIN', 'P', 8, 100, 0.02), None)
+        
+        rejected = record_trades([('TEA', 5, 'B', 135, 1), ('TEA', 15, 'S', 120), ('COF', 5, 'B', 10),
+                                  ('GIN', 20, 'S', 56), ('TEA', 18, 'B', 130, -1), ('GIN', 0, 'B', 70),
+                                  ('GIN', 10, 'B', 70, -2), ('TEA', 15, 'C', 120), ('TEA', 'B', 'S', 120),
+                                  ('TEA', 15, 'S', -120), ('TEA', 15)])
+        
+        self.assertEqual(rejected, [(2, "Stock COF is not yet created."), (5, "Quantity needs to be positive."),
+                                    (7, "Buy or sell indicator is not properly set."),
+                                    (8, "Please set all arguments correctly."),
+                                    (9, "Stock price needs to be positive."), 
+                                    (10, "Please set all arguments correctly.")])
+        self.assertEqual(in_seconds(stocks['TEA'].trade_records), [(-1, 5, 'B', 135),
+                               (0, 15, 'S', 120), (1, 18, 'B', 130)])
+        self.assertEqual(in_seconds(stocks['GIN'].trade_records), [(0, 20, 'S', 56), (2, 10, 'B', 70)])
+        
+        # older trades than the recorded ones are put in their places
+        self.assertEqual(record_trades([('TEA', 4, 'B', 150, 2000), ('TEA', 10, 'S', 125, 50)]), [])
+        self.assertEqual(in_seconds(stocks['TEA'].trade_records), [(-2000, 4, 'B', 150), (-50, 10, 'S', 125),
+                               (-1, 5, 'B', 135), (0, 15, 'S', 120), (1, 18, 'B', 130)])
+        self.assertEqual(volume_weighted_stock_price('TEA'), 
+                         (10*125 + 5*135 + 15*120 + 18*130)/(10+5+15+18))
+        
+        # time_shift which gives no timestamp rejects only its own row
+        self.assertEqual(record_trades([('TEA', 1, 'B', 100, float('inf')), ('GIN', 1, 'B', 100, float('nan')),
+                                        ('TEA', 1, 'B', 100, 1e12), ('GIN', 1, 'B', 75)]),
+                         [(0, "Please set all arguments correctly."), (1, "Please set all arguments correctly."),
+                          (2, "Please set all arguments correctly.")])
+        self.assertEqual(len(stocks['TEA'].trade_records), 5)
+        self.assertEqual(len(stocks['GIN'].trade_records), 3)
+        
+        stocks.clear()
+        
+    def test_recording_trade_columns(self):
+        with self.assertRaises(Error, msg= "Stock TEA is not yet created."):
+            record_trade_columns('TEA', [5], 'B', [135])
+            
+        self.assertEqual(create_stock('TEA', 'C', 5, 100), None)
+        self.assertEqual(record_trade_columns('TEA', [5, 15, 18], 'BSB', [135, 120, 130], [1, 0, -1]), [])
+        self.assertEqual(record_trade_columns('TEA', [], '', []), [])
+        self.assertEqual(in_seconds(stocks['TEA'].trade_records), [(-1, 5, 'B', 135),
+                               (0, 15, 'S', 120), (1, 18, 'B', 130)])
+        
+        self.assertEqual(record_trade_columns('TEA', [4, -4, 10], ['B', 'B', 'X'], [150, 150, 125]),
+                         [(1, "Quantity needs to be positive."), 
+                          (2, "Buy or sell indicator is not properly set.")])
+        self.assertEqual(len(stocks['TEA'].trade_records), 4)
+        self.assertEqual(volume_weighted_stock_price('TEA'), (5*135 + 15*120 + 4*150 + 18*130)/(5+15+4+18))
+        
+        self.assertEqual(record_trade_columns('TEA', [1, 1, 1], 'BBB', [100, 100, 100], [0, float('inf'), float('nan')]),
+                         [(1, "Please set all arguments correctly."), (2, "Please set all arguments correctly.")])
+        self.assertEqual(len(stocks['TEA'].trade_records), 5)
+        
+        with self.assertRaises(Error, msg= "Columns need to be of the same length."):
+            record_trade_columns('TEA', [5, 15], 'B', [135, 120])
+            
+        with self.assertRaises(Error, msg= "Please set all arguments correctly."):
+            record_trade_columns('TEA', 5, 'B', 135)
+        
+        stocks.clear()
+        
     def test_volume_weighted_stock_price(self):
         with self.assertRaises(Error, msg= "Stock TEA is not yet created."):
             volume_weighted_stock_price('TEA')
@@ -215,14 +318,143 @@ class MyTest(unittest.TestCase):
         self.assertEqual(record_trade('TEA', 18, 'B', 130), None)
         self.assertEqual(record_trade('GIN', 10, 'B', 70, -2), None)
         
-        self.assertEqual(stocks['TEA'].trade_records, [(-1000, 5, 'B', 135),
+        self.assertEqual(in_seconds(stocks['TEA'].trade_records), [(-1000, 5, 'B', 135),
                                (-100, 15, 'S', 120), (0, 18, 'B', 130)])
 
-        self.assertEqual(stocks['GIN'].trade_records, [(-500, 20, 'S', 56), (2, 10, 'B', 70)])
+        self.assertEqual(in_seconds(stocks['GIN'].trade_records), [(-500, 20, 'S', 56), (2, 10, 'B', 70)])
         
         self.assertEqual(volume_weighted_stock_price('TEA'), (15*120 + 18*130)/(15+18))
         self.assertEqual(volume_weighted_stock_price('GIN'), (20*56 + 10*70)/(20+10))
         
+        # late trades are put in their place, and do not hide newer trades from the window
+        self.assertEqual(record_trade('TEA', 10, 'S', 125, 50), None)
+        self.assertEqual(record_trade('TEA', 4, 'B', 150, 2000), None)
+        self.assertEqual(in_seconds(stocks['TEA'].trade_records), [(-2000, 4, 'B', 150), (-1000, 5, 'B', 135),
+                               (-100, 15, 'S', 120), (-50, 10, 'S', 125), (0, 18, 'B', 130)])
+        self.assertEqual(volume_weighted_stock_price('TEA'), (15*120 + 10*125 + 18*130)/(15+10+18))
+        
+        stocks.clear()
+        
+    def test_volume_weighted_stock_price_between(self):
+        with self.assertRaises(Error, msg= "Stock TEA is not yet created."):
+            volume_weighted_stock_price_between('TEA', 0, 1)
+            
+        self.assertEqual(create_stock('TEA', 'C', 5, 100), None)
+        self.assertEqual(record_trade('TEA', 15, 'S', 120, 100), None)
+        self.assertEqual(record_trade('TEA', 18, 'B', 130), None)
+        self.assertEqual(record_trade('TEA', 5, 'B', 135, 1000), None)
+        start = market.clock.time()
+        
+        self.assertEqual(volume_weighted_stock_price_between('TEA', start - 1000, start - 100), 
+                         (5*135 + 15*120)/(5+15))
+        self.assertEqual(volume_weighted_stock_price_between('TEA', start - 999, start), 
+                         (15*120 + 18*130)/(15+18))
+        self.assertEqual(volume_weighted_stock_price_between('TEA', start - 99, start - 1), 0)
+        
+        with self.assertRaises(Error, msg= "Start of the period needs to be before its end."):
+            volume_weighted_stock_price_between('TEA', start, start - 100)
+            
+        with self.assertRaises(Error, msg= "Please set all arguments correctly."):
+            volume_weighted_stock_price_between('TEA', 'C', start)
+        
+        stocks.clear()
+        
+    def test_trade_store(self):
+        records = TradeStore()
+        self.assertEqual(records, [])
+        records.append(-1, 5, 'B', 135)
+        records.append(0, 15, 'S', 120.5)
+        
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[-1], (0, 15, 'S', 120.5))
+        self.assertEqual(records[:], [(-1, 5, 'B', 135), (0, 15, 'S', 120.5)])
+        self.assertEqual(list(reversed(records)), [(0, 15, 'S', 120.5), (-1, 5, 'B', 135)])
+        self.assertEqual(records.sides, bytearray(b'BS'))
+        
+        with self.assertRaises(ValueError):
+            records.append(1, 'B', 'S', 120)
+        self.assertEqual(len(records.timestamps), len(records.quantities))
+        
+        self.assertEqual(records.insert(-1, 7, 'S', 110), 1)
+        self.assertEqual(records.insert(5, 1, 'B', 100), 3)
+        self.assertEqual(records.insert(-3, 2, 'B', 90), 0)
+        self.assertEqual(list(records.timestamps), [-3, -1, -1, 0, 5])
+        self.assertEqual(records.bounds(-1, 0), (1, 4))
+        self.assertEqual(records.volume_weighted_price(-1, 0), (5*135 + 7*110 + 15*120.5)/(5+7+15))
+        
+        # running totals follow inserted, appended and dropped trades
+        self.assertTrue(records.extend(array('q', [6, 7]), array('d', [3, 4]), b'BS', array('d', [80, 70])))
+        self.assertEqual(records.sums(0, 7), (37, 2*90 + 5*135 + 7*110 + 15*120.5 + 100 + 240 + 280))
+        self.assertEqual(records.sums(1, 4), (5+7+15, 5*135 + 7*110 + 15*120.5))
+        self.assertEqual(records.sums(2, 2), (0, 0))
+        records.drop_oldest(3)
+        self.assertEqual(records.sums(0, 4), (15 + 1 + 3 + 4, 15*120.5 + 100 + 240 + 280))
+        self.assertEqual(records.volume_weighted_price(5, 7), (100 + 240 + 280)/8)
+        
+        # totals are kept per block of trades, long ranges add partial blocks at both ends
+        records = TradeStore()
+        for number in range(500):
+            records.append(2 * number, number % 7 + 1, 'B', number % 13 + 90)
+        for number in range(40):
+            records.insert(25 * number + 1, 3, 'S', 50)
+        records.extend(array('q', range(1000, 1100)), array('d', [2] * 100), b'B' * 100, array('d', [70] * 100))
+        records.drop_oldest(10)
+        self.assertEqual(len(records.quantity_totals), len(records) // TradeStore.TOTALS_BLOCK)
+        for first, last in [(0, len(records)), (1, 400), (63, 65), (100, 357), (300, 630)]:
+            quantities = records.quantities[first:last]
+            self.assertEqual(records.sums(first, last),
+                             (sum(quantities), sum(q * p for q, p in zip(quantities, records.prices[first:last]))))
+        
+    def test_volume_window(self):
+        records = TradeStore()
+        window = VolumeWindow(records, 900)
+        self.assertEqual(window.price(-900), 0)
+        
+        for record in [(-1000, 5, 'B', 135), (-100, 15, 'S', 120), (0, 18, 'B', 130)]:
+            window.add(records.insert(*record), record[1], record[3])
+        self.assertEqual(window.price(-900), (15*120 + 18*130)/(15+18))
+        self.assertEqual(window.head, 1)
+        
+        window.add(records.insert(-2000, 4, 'B', 150), 4, 150)
+        self.assertEqual(window.head, 2)
+        window.add(records.insert(-50, 10, 'S', 125), 10, 125)
+        self.assertEqual(window.price(-900), (15*120 + 10*125 + 18*130)/(15+10+18))
+        
+        self.assertEqual(window.price(-40), 130)
+        self.assertEqual(window.price(1), 0)
+        self.assertEqual((window.quantity_sum, window.quantity_price_sum), (0, 0))
+        
+    def test_bars(self):
+        with self.assertRaises(Error, msg= "Stock TEA is not yet created."):
+            ohlcv_bar('TEA')
+            
+        self.assertEqual(create_stock('TEA', 'C', 5, 100), None)
+        self.assertEqual(ohlcv_bar('TEA'), None)
+        self.assertEqual(record_trade('TEA', 5, 'B', 135, 3000), None)
+        self.assertEqual(record_trade('TEA', 15, 'S', 120, 1000), None)
+        self.assertEqual(record_trade('TEA', 10, 'B', 140, 200), None)
+        self.assertEqual(record_trade('TEA', 18, 'B', 130, 30), None)
+        
+        self.assertEqual(ohlcv_bar('TEA', 1), (130, 130, 130, 130, 18))
+        self.assertEqual(ohlcv_bar('TEA', 5), (140, 140, 130, 130, 28))
+        self.assertEqual(ohlcv_bar('TEA'), (140, 140, 130, 130, 28))
+        self.assertEqual(ohlcv_bar('TEA', 60), (135, 140, 120, 130, 48))
+        self.assertEqual(volume_weighted_stock_price('TEA', 1), 130)
+        self.assertEqual(volume_weighted_stock_price('TEA', 60), (5*135 + 15*120 + 10*140 + 18*130)/48)
+        
+        # late trade moves indices of the newer trades in every window
+        self.assertEqual(record_trade('TEA', 2, 'S', 150, 500), None)
+        self.assertEqual(record_trade('TEA', 1, 'S', 110, 40), None)
+        self.assertEqual(ohlcv_bar('TEA', 1), (110, 130, 110, 130, 19))
+        self.assertEqual(ohlcv_bar('TEA', 15), (150, 150, 110, 130, 31))
+        self.assertEqual(ohlcv_bar('TEA', 60), (135, 150, 110, 130, 51))
+        
+        self.assertEqual(record_trades([('TEA', 1, 'B', 125), ('TEA', 1, 'B', 160)]), [])
+        self.assertEqual(ohlcv_bar('TEA', 1), (110, 160, 110, 160, 21))
+        
+        with self.assertRaises(Error, msg= "Window of 2 minutes is not configured."):
+            ohlcv_bar('TEA', 2)
+        
         stocks.clear()
         
     def test_gbce_all_share_index(self):
@@ -242,16 +474,902 @@ class MyTest(unittest.TestCase):
         self.assertEqual(record_trade('POP', 18, 'B', 130), None)
         self.assertEqual(record_trade('GIN', 10, 'B', 70, -2), None)
         
-        self.assertEqual(stocks['TEA'].trade_records, [(-1000, 5, 'B', 135),
+        self.assertEqual(in_seconds(stocks['TEA'].trade_records), [(-1000, 5, 'B', 135),
                                (-100, 15, 'S', 120)])
 
-        self.assertEqual(stocks['GIN'].trade_records, [(-500, 20, 'S', 56), (2, 10, 'B', 70)])
+        self.assertEqual(in_seconds(stocks['GIN'].trade_records), [(-500, 20, 'S', 56), (2, 10, 'B', 70)])
+        
+        self.assertEqual(in_seconds(stocks['POP'].trade_records), [(0, 18, 'B', 130)])
+        
+        # index is kept as a running sum of logarithms, so it is equal only up to float rounding
+        self.assertAlmostEqual(gbce_all_share_index(), gmean([120, 70,130]))
+        
+        # late trade does not change the last price
+        self.assertEqual(record_trade('POP', 10, 'S', 150, 10), None)
+        self.assertAlmostEqual(gbce_all_share_index(), gmean([120, 70,130]))
+        self.assertEqual(record_trade('POP', 10, 'S', 150, -10), None)
+        self.assertAlmostEqual(gbce_all_share_index(), gmean([120, 70,150]))
+        
+        self.assertEqual(record_trades([('TEA', 5, 'B', 110), ('GIN', 5, 'B', 80, 1000)]), [])
+        self.assertAlmostEqual(gbce_all_share_index(), gmean([110, 70,150]))
+        
+        remove_stock('POP')
+        self.assertAlmostEqual(gbce_all_share_index(), gmean([110, 70]))
+        
+        stocks.recompute_index()
+        self.assertAlmostEqual(gbce_all_share_index(), gmean([110, 70]))
+        self.assertTrue(all(shard.index.updates == 0 for shard in stocks.shards))
+
+        # every other way of changing the dictionary keeps the index as well
+        tea, gin = stocks['TEA'], stocks['GIN']
+        self.assertEqual(stocks.popitem(), ('GIN', gin))
+        self.assertAlmostEqual(gbce_all_share_index(), 110)
+        self.assertEqual(stocks.popitem(), ('TEA', tea))
+        with self.assertRaises(Error, msg= "There are no trade records."):
+            gbce_all_share_index()
+        stocks.update({'TEA': tea})
+        self.assertAlmostEqual(gbce_all_share_index(), 110)
+        self.assertTrue(stocks.setdefault('GIN', gin) is gin)
+        self.assertTrue(stocks.setdefault('GIN', tea) is gin)
+        self.assertAlmostEqual(gbce_all_share_index(), gmean([110, 70]))
+        self.assertTrue(stocks.shard('GIN').stocks['GIN'] is gin)
+
+        stocks.clear()
+        
+        with self.assertRaises(Error, msg= "There are no trade records."):
+            gbce_all_share_index()        
+
+class MarketTest(unittest.TestCase):
+    def test_separate_market(self):
+        market = Market(shard_count = 4)
+        self.assertEqual(market.create_stock('TEA', 'C', 5, 100), None)
+        self.assertEqual(market.record_trade('TEA', 5, 'B', 135), None)
+        self.assertFalse('TEA' in stocks)
+        self.assertEqual(market.volume_weighted_stock_price('TEA'), 135)
+        self.assertAlmostEqual(market.gbce_all_share_index(), 135)
+        
+        market.remove_stock('TEA')
+        self.assertEqual(market.stocks, {})
+        self.assertTrue(all(shard.stocks == {} for shard in market.shards))
+        
+    def test_recording_trades_from_threads(self):
+        market = Market(shard_count = 4)
+        names = ['S%d' % number for number in range(8)]
+        for name in names:
+            market.create_stock(name, 'C', 5, 100)
+        
+        def record(name, price):
+            for _ in range(1000):
+                market.record_trade(name, 1, 'B', price)
+                market.volume_weighted_stock_price(name)
+                market.gbce_all_share_index()
+        
+        threads = [threading.Thread(target=record, args=(name, 10 * (number + 1))) 
+                   for number, name in enumerate(names)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        self.assertTrue(all(len(market.stocks[name].trade_records) == 1000 for name in names))
+        self.assertAlmostEqual(market.gbce_all_share_index(), gmean([10 * (number + 1) for number in range(8)]))
+        
+    def test_stock_removed_while_recording_trades(self):
+        class RemovingMarket(Market):
+            # another thread removes the stock right after it was checked
+            def _trade_code(self, *args):
+                code = Market._trade_code(self, *args)
+                self.stocks.pop('TEA', None)
+                return code
+        
+        market = RemovingMarket(shard_count = 4)
+        market.create_stock('TEA', 'C', 5, 100)
+        self.assertEqual(market.record_trades([('TEA', 1, 'B', 100), ('TEA', 2, 'B', 100)]),
+                         [(0, "Stock TEA is not yet created."), (1, "Stock TEA is not yet created.")])
+        self.assertEqual(market.rejection_counts(), {STOCK_NOT_CREATED: 2})
+
+    def test_late_trades_in_bar_windows(self):
+        clock = SimulatedClock(now = 1000 * NANOSECONDS)
+        market = Market(shard_count = 4, clock = clock)
+        market.create_stock('TEA', 'C', 5, 100)
+        count = 100000
+        prices = [100 + number % 17 for number in range(count)]
+        market.record_trade_columns('TEA', [1] * count, 'B' * count, prices,
+                                    [(count - number) * 0.01 for number in range(count)])
+        bars = market.stocks['TEA'].bars
+        self.assertEqual(market.ohlcv_bar('TEA', 60), (100, 116, 100, prices[-1], count))
+        highs = len(bars.window(60).highs)
+        
+        # late trades do not rebuild the windows, however many trades they hold
+        for number in range(10):
+            market.record_trade('TEA', 1, 'S', 90 + number, 500 + number)
+        self.assertTrue(bars.window(60).stale and bars.window(15).stale)
+        self.assertEqual(len(bars.window(60).highs), highs)
+        # trades older than the 1 minute window only move it
+        self.assertFalse(bars.window(1).stale)
+        self.assertEqual(market.ohlcv_bar('TEA', 1), (prices[-6000], 116, 100, prices[-1], 6000))
+        
+        # stale window is rebuilt once, by the query
+        self.assertEqual(market.ohlcv_bar('TEA', 60), (100, 116, 90, prices[-1], count + 10))
+        self.assertFalse(bars.window(60).stale)
+        market.record_trade('TEA', 1, 'S', 200)
+        self.assertEqual(market.ohlcv_bar('TEA', 60), (100, 200, 90, 200, count + 11))
+        
+    def test_retention_policy(self):
+        spilled = []
+        market = Market(shard_count = 4, retention = RetentionPolicy(max_trades = 100,
+                                                                    spill = lambda stock, *columns: spilled.append(columns)))
+        market.create_stock('TEA', 'C', 5, 100)
+        # old trades, outside of all bar windows
+        for number in range(1000):
+            market.record_trade('TEA', 1, 'B', 100 + number % 10, 7200 - number)
+        records = market.stocks['TEA'].trade_records
+        self.assertTrue(len(records) < 200)
+        self.assertEqual(len(records) + records.dropped, 1000)
+        self.assertEqual(sum(len(columns[0]) for columns in spilled), records.dropped)
+        self.assertEqual(list(spilled[0][1]), [1] * len(spilled[0][1]))
+        self.assertEqual(records.sums(0, len(records)), (len(records), sum(records.prices)))
+        
+        # trades inside the window are never dropped
+        market.record_trades([('TEA', 2, 'S', 50)] * 500)
+        self.assertTrue(len(records) >= 500)
+        self.assertEqual(market.volume_weighted_stock_price('TEA'), 50)
+        
+    def test_window_only_retention(self):
+        market = Market(shard_count = 4, retention = RetentionPolicy(max_age = 0))
+        market.create_stock('TEA', 'C', 5, 100)
+        market.record_trade_columns('TEA', [1] * 1000, 'B' * 1000, [120] * 1000, range(10800, 6800, -4))
+        market.record_trade('TEA', 1, 'B', 130, 1800)
+        market.record_trade('TEA', 1, 'B', 140, 1200)
+        records = market.stocks['TEA'].trade_records
+        # trades outside all windows are dropped, GBCE All Share Index still has the newest price
+        self.assertTrue(len(records) < 100)
+        self.assertEqual(records[-1][3], 140)
+        self.assertEqual(market.volume_weighted_stock_price('TEA'), 0)
+        self.assertAlmostEqual(market.gbce_all_share_index(), 140)
+        
+    @unittest.skipUnless(numpy, "NumPy is not installed")
+    def test_dividend_yields_and_pe_ratios(self):
+        market = Market(shard_count = 4)
+        market.create_stock('TEA', 'C', 0, 100)
+        market.create_stock('POP', 'C', 8, 100)
+        market.create_stock('GIN', 'P', 8, 100, 0.02)
+        names = ['TEA', 'POP', 'GIN', 'COF', 'POP']
+        prices = numpy.array([100, 80, 150, 10, 0])
+        
+        yields = market.dividend_yields(names, prices)
+        self.assertEqual(list(yields[:3]), [0, 8/80, 0.02*100/150])
+        self.assertEqual(list(numpy.isnan(yields)), [False, False, False, True, True])
+        ratios = market.pe_ratios(names, prices)
+        self.assertEqual(list(numpy.isnan(ratios)), [True, False, False, True, True])
+        self.assertEqual(list(ratios[1:3]), [80/8, 150/8])
+        self.assertEqual([market.pe_ratio(name, price) for name, price in zip(names[1:3], prices[1:3])], 
+                         list(ratios[1:3]))
+        
+        with self.assertRaises(Error, msg= "Columns need to be of the same length."):
+            market.dividend_yields(names, prices[:2])
+        with self.assertRaises(Error, msg= "Please set all arguments correctly."):
+            market.pe_ratios(names, ['B'] * 5)
+        
+    def test_reference_table(self):
+        market = Market(shard_count = 4)
+        market.create_stock('TEA', 'C', 5, 100)
+        market.create_stock('GIN', 'P', 8, 100, 0.02)
+        tea, gin = market.stock_id('TEA'), market.stock_id('GIN')
+        self.assertEqual((tea, gin), (0, 1))
+        reference = market.stocks.reference
+        self.assertEqual(reference.stock_types, bytearray(b'CP'))
+        self.assertEqual(list(reference.last_dividends), [5, 8])
+        
+        market.change_stock_type('TEA', 'P', 0.05)
+        market.change_par_value('GIN', 50)
+        self.assertEqual((reference.stock_types[tea], reference.fixed_dividends[tea]), (ord('P'), 0.05))
+        self.assertEqual(reference.par_values[gin], 50)
+        with self.assertRaises(AttributeError):
+            market.stocks['TEA'].extra = 1
+        
+        # ids can be used instead of names
+        self.assertEqual(market.record_trade(gin, 10, 'B', 70), None)
+        self.assertEqual(market.volume_weighted_stock_price(gin), 70)
+        self.assertEqual(market.dividend_yield(gin, 100), market.dividend_yield('GIN', 100))
+        with self.assertRaises(Error, msg= "Stock id 5 is not known."):
+            market.pe_ratio(5, 100)
+        
+        # removed stock keeps its id
+        market.remove_stock('TEA')
+        self.assertEqual(reference.stock_types[tea], 0)
+        with self.assertRaises(Error, msg= "Stock TEA is not yet created."):
+            market.pe_ratio(tea, 100)
+        market.create_stock('TEA', 'C', 5, 100)
+        self.assertEqual(market.stock_id('TEA'), tea)
+        
+        if numpy is not None:
+            self.assertEqual(list(market.dividend_yields(numpy.array([gin, tea]), [100, 50])), [0.02*50/100, 5/50])
+            self.assertTrue(numpy.isnan(market.pe_ratios(numpy.array([7, -1]), [100, 100])).all())
+        
+    def test_index_history(self):
+        history = IndexHistory(0)
+        generator = random.Random(0)
+        samples = [(timestamp * 10, generator.uniform(50, 150)) for timestamp in range(300)]
+        for timestamp, value in samples:
+            history.add(timestamp, value)
+        self.assertEqual(len(history), 300)
+        for _ in range(200):
+            timestamp_from = generator.randint(-20, 3000)
+            timestamp_to = timestamp_from + generator.randint(0, 1000)
+            values = [value for timestamp, value in samples if timestamp_from <= timestamp <= timestamp_to]
+            self.assertEqual(history.low_high(timestamp_from, timestamp_to),
+                             (min(values), max(values)) if values else None)
+        
+        clock = SimulatedClock()
+        market = Market(shard_count = 4, clock = clock, index_tick = 60)
+        market.create_stock('TEA', 'C', 5, 100)
+        market.create_stock('GIN', 'C', 5, 100)
+        with self.assertRaises(Error, msg= "There are no index samples in the period."):
+            market.gbce_all_share_index_low_high(0, 60)
+        market.record_trade('TEA', 10, 'B', 100)
+        # samples are taken at most once per tick
+        clock.advance(30)
+        market.record_trade('TEA', 10, 'B', 400)
+        clock.advance(30)
+        market.record_trades([('TEA', 10, 'B', 300), ('GIN', 10, 'B', 75)])
+        clock.advance(60)
+        market.record_trade_columns('GIN', [10], 'S', [300])
+        self.assertEqual([round(value, 9) for value in market.index_history.values], [100, 150, 300])
+        self.assertEqual(list(market.index_history.timestamps), [0, 60 * NANOSECONDS, 120 * NANOSECONDS])
+        for time_from, time_to, low_high in [(0, 120, (100, 300)), (1, 120, (150, 300)), (1, 119, (150, 150))]:
+            low, high = market.gbce_all_share_index_low_high(time_from, time_to)
+            self.assertAlmostEqual(low, low_high[0])
+            self.assertAlmostEqual(high, low_high[1])
+        
+        with self.assertRaises(Error, msg= "Start of the period needs to be before its end."):
+            market.gbce_all_share_index_low_high(60, 0)
+        with self.assertRaises(Error, msg= "Index history is not kept, market needs to be created with index_tick."):
+            Market(shard_count = 4).gbce_all_share_index_low_high(0, 60)
+        
+    def test_result_cache(self):
+        clock = SimulatedClock()
+        market = Market(shard_count = 4, clock = clock, cache_size = 4)
+        cache = market.cache
+        market.create_stock('TEA', 'C', 5, 100)
+        market.create_stock('GIN', 'P', 8, 100, 0.02)
+        self.assertEqual(market.dividend_yield('TEA', 100), 0.05)
+        self.assertEqual(market.dividend_yield('TEA', 100), 0.05)
+        self.assertEqual(market.pe_ratio('GIN', 80), 10)
+        self.assertEqual(len(cache), 2)
+        
+        # trades do not change dividend yield, its result stays valid
+        market.record_trade('TEA', 10, 'B', 100)
+        stock, version = cache.get(('dividend_yield', 'TEA', 100))[:2]
+        self.assertEqual(stock.reference_version, version)
+        self.assertEqual(market.volume_weighted_stock_price('TEA'), 100)
+        self.assertAlmostEqual(market.gbce_all_share_index(), 100)
+        self.assertEqual(market.volume_weighted_stock_price('TEA'), 100)
+        
+        # every change is seen at once
+        market.change_last_dividend('TEA', 10)
+        self.assertEqual(market.dividend_yield('TEA', 100), 0.1)
+        market.change_stock_type('TEA', 'P', 0.5)
+        self.assertEqual(market.dividend_yield('TEA', 100), 0.5)
+        market.change_par_value('TEA', 10)
+        self.assertEqual(market.dividend_yield('TEA', 100), 0.05)
+        market.change_fixed_dividend('TEA', 1)
+        self.assertEqual(market.dividend_yield('TEA', 100), 0.1)
+        market.change_last_dividend('GIN', 16)
+        self.assertEqual(market.pe_ratio('GIN', 80), 5)
+        
+        clock.advance(60)
+        market.record_trade('TEA', 30, 'S', 200)
+        self.assertEqual(market.volume_weighted_stock_price('TEA'), 175)
+        self.assertAlmostEqual(market.gbce_all_share_index(), 200)
+        market.record_trade('GIN', 10, 'B', 50)
+        self.assertAlmostEqual(market.gbce_all_share_index(), 100)
+        # cached price expires when a trade leaves the window
+        clock.advance(14 * 60)
+        self.assertEqual(market.volume_weighted_stock_price('TEA'), 175)
+        clock.advance(1)
+        self.assertEqual(market.volume_weighted_stock_price('TEA'), 200)
+        
+        market.remove_stock('TEA')
+        with self.assertRaises(Error, msg= "Stock TEA is not yet created."):
+            market.dividend_yield('TEA', 100)
+        with self.assertRaises(Error, msg= "Stock TEA is not yet created."):
+            market.volume_weighted_stock_price('TEA')
+        self.assertAlmostEqual(market.gbce_all_share_index(), 50)
+        market.create_stock('TEA', 'C', 5, 100)
+        self.assertEqual(market.dividend_yield('TEA', 100), 0.05)
+        self.assertEqual(market.volume_weighted_stock_price('TEA'), 0)
+        self.assertTrue(len(cache) <= 4)
+        
+        with self.assertRaises(Error, msg= "Please set all arguments correctly."):
+            market.dividend_yield('TEA', [100])
+
+        # stocks removed from the registry directly are not served from the cache either
+        market.record_trade('TEA', 10, 'B', 100)
+        self.assertEqual(market.volume_weighted_stock_price('TEA'), 100)
+        del market.stocks['TEA']
+        with self.assertRaises(Error, msg= "Stock TEA is not yet created."):
+            market.dividend_yield('TEA', 100)
+        with self.assertRaises(Error, msg= "Stock TEA is not yet created."):
+            market.volume_weighted_stock_price('TEA')
+        self.assertEqual(market.pe_ratio('GIN', 80), 5)
+        market.stocks.clear()
+        with self.assertRaises(Error, msg= "Stock GIN is not yet created."):
+            market.pe_ratio('GIN', 80)
+
+    def test_snapshots(self):
+        clock = SimulatedClock()
+        market = Market(shard_count = 4, clock = clock)
+        market.create_stock('TEA', 'C', 5, 100)
+        market.create_stock('GIN', 'P', 8, 100, 0.02)
+        market.create_stock('JOE', 'C', 13, 250)
+        market.record_trade('TEA', 10, 'B', 100)
+        market.record_trade('GIN', 10, 'B', 50)
+        first = market.snapshot()
+        self.assertTrue(market.published is first)
+        
+        # snapshot does not see what happens after it was published
+        clock.advance(61)
+        market.record_trade('TEA', 30, 'S', 200)
+        market.change_last_dividend('JOE', 20)
+        market.remove_stock('GIN')
+        self.assertEqual(first.volume_weighted_stock_price('TEA'), 100)
+        self.assertEqual(first.volume_weighted_stock_price('TEA', 1), 100)
+        self.assertEqual(first.ohlcv_bar('GIN'), (50, 50, 50, 50, 10))
+        self.assertEqual(first.pe_ratio('JOE', 26), 2)
+        self.assertEqual(first.dividend_yield('GIN', 100), 0.02)
+        self.assertAlmostEqual(first.gbce_all_share_index(), gmean([100, 50]))
+        self.assertEqual(first.stocks['JOE'].last_price, None)
+        
+        # only changed stocks get a new state
+        second = market.snapshot()
+        self.assertTrue(second.stocks['TEA'] is not first.stocks['TEA'])
+        self.assertTrue(second.stocks['JOE'] is not first.stocks['JOE'])
+        self.assertFalse('GIN' in second.stocks)
+        self.assertEqual(second.volume_weighted_stock_price('TEA'), 175)
+        self.assertEqual(second.volume_weighted_stock_price('TEA', 1), 200)
+        self.assertEqual(second.pe_ratio('JOE', 40), 2)
+        self.assertAlmostEqual(second.gbce_all_share_index(), 200)
+        self.assertTrue(market.snapshot().stocks['JOE'] is second.stocks['JOE'])
+        self.assertTrue(market.snapshot().stocks['TEA'] is second.stocks['TEA'])
+        
+        # state of a stock without changes is read again when a trade leaves its window
+        clock.advance(30)
+        self.assertTrue(market.snapshot().stocks['TEA'] is second.stocks['TEA'])
+        clock.advance(31)
+        self.assertEqual(market.snapshot().volume_weighted_stock_price('TEA', 1), 0)
+        clock.advance(13 * 60)
+        third = market.snapshot()
+        self.assertTrue(third.stocks['JOE'] is second.stocks['JOE'])
+        self.assertEqual(third.volume_weighted_stock_price('TEA'), 200)
+        self.assertEqual(third.ohlcv_bar('TEA', 60), (100, 200, 100, 200, 40))
+        self.assertEqual(third.stocks['TEA'].last_price, 200)
+        
+        with self.assertRaises(Error, msg= "Stock GIN is not yet created."):
+            third.dividend_yield('GIN', 100)
+        with self.assertRaises(Error, msg= "Window of 2 minutes is not configured."):
+            third.volume_weighted_stock_price('TEA', 2)
+        with self.assertRaises(Error, msg= "Stock price needs to be positive."):
+            third.pe_ratio('TEA', 0)
+        
+    def test_snapshots_from_threads(self):
+        market = Market(shard_count = 4)
+        names = ['S%d' % number for number in range(8)]
+        for name in names:
+            market.create_stock(name, 'C', 5, 100)
+        recording = True
+        
+        def record():
+            for _ in range(200):
+                for number, name in enumerate(names):
+                    market.record_trade(name, 1, 'B', 10 * (number + 1))
+            
+        def read(errors):
+            while recording:
+                snapshot = market.snapshot()
+                prices = [state.last_price for state in snapshot.stocks.values() if state.last_price is not None]
+                # index of a snapshot always matches the prices in it
+                if prices and abs(snapshot.gbce_all_share_index() - gmean(prices)) > 1e-9:
+                    errors.append(snapshot)
+        
+        errors = []
+        readers = [threading.Thread(target=read, args=(errors,)) for _ in range(2)]
+        for thread in readers:
+            thread.start()
+        record()
+        recording = False
+        for thread in readers:
+            thread.join()
+        self.assertEqual(errors, [])
+        
+class RejectionTest(unittest.TestCase):
+    def test_result_codes(self):
+        market = Market(shard_count = 4)
+        market.create_stock('TEA', 'C', 5, 100)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertEqual(market.try_record_trade('TEA', 5, 'B', 135), RECORDED)
+            self.assertEqual(market.try_record_trade('COF', 5, 'B', 135), STOCK_NOT_CREATED)
+            self.assertEqual(market.try_record_trade('TEA', 5, 'B', 0), PRICE_NOT_POSITIVE)
+            self.assertEqual(market.try_record_trade('TEA', 0, 'B', 135), QUANTITY_NOT_POSITIVE)
+            self.assertEqual(market.try_record_trade('TEA', 5, 'X', 135), SIDE_NOT_SET)
+            self.assertEqual(market.try_record_trade('TEA', 'B', 'S', 135), ARGUMENTS_NOT_SET)
+            self.assertEqual(market.try_record_trade(['TEA'], 5, 'B', 135), ARGUMENTS_NOT_SET)
+            self.assertEqual(market.try_record_trade(7, 5, 'B', 135), ARGUMENTS_NOT_SET)
+            self.assertEqual(market.record_trades([('TEA', 5, 'B', -1), ('COF', 1, 'B', 1), ('TEA', 1, 'B', 1)], 
+                                                  result_codes = True), 
+                             [(0, PRICE_NOT_POSITIVE), (1, STOCK_NOT_CREATED)])
+            with self.assertRaises(Error, msg= "Stock COF is not yet created."):
+                market.record_trade('COF', 5, 'B', 135)
+        # nothing is printed
+        self.assertEqual(output.getvalue(), '')
+        self.assertEqual(len(market.stocks['TEA'].trade_records), 2)
+        self.assertEqual(market.rejection_counts(), {STOCK_NOT_CREATED: 3, PRICE_NOT_POSITIVE: 2, 
+                                                     QUANTITY_NOT_POSITIVE: 1, SIDE_NOT_SET: 1, ARGUMENTS_NOT_SET: 3})
+        
+    def test_nan_is_rejected(self):
+        market = Market(shard_count = 4)
+        market.create_stock('TEA', 'C', 5, 100)
+        nan = float('nan')
+        with self.assertRaises(Error, msg= "Stock price needs to be positive."):
+            market.record_trade('TEA', 1, 'B', nan)
+        self.assertEqual(market.try_record_trade('TEA', nan, 'B', 100), QUANTITY_NOT_POSITIVE)
+        self.assertEqual(market.record_trades([('TEA', 1, 'B', 100), ('TEA', 1, 'B', nan)]),
+                         [(1, "Stock price needs to be positive.")])
+        self.assertEqual(market.record_trades([('TEA', 1, 'B', 100), ('TEA', nan, 'B', 100)], result_codes = True),
+                         [(1, QUANTITY_NOT_POSITIVE)])
+        self.assertEqual(market.record_trade_columns('TEA', [1, 1], 'BB', [100, nan]),
+                         [(1, "Stock price needs to be positive.")])
+        self.assertEqual(market.record_trade_columns('TEA', array('d', [1, nan]), 'BB', [100, 100]),
+                         [(1, "Quantity needs to be positive.")])
+        self.assertEqual(len(market.stocks['TEA'].trade_records), 4)
+        self.assertEqual(market.rejection_counts(), {PRICE_NOT_POSITIVE: 3, QUANTITY_NOT_POSITIVE: 3})
+        
+        # time_shift which gives no timestamp is rejected without an exception as well
+        self.assertEqual(market.try_record_trade('TEA', 1, 'B', 100, nan), ARGUMENTS_NOT_SET)
+        self.assertEqual(market.try_record_trade('TEA', 1, 'B', 100, float('inf')), ARGUMENTS_NOT_SET)
+        self.assertEqual(market.try_record_trade('TEA', 1, 'B', 100, 1e12), ARGUMENTS_NOT_SET)
+        with self.assertRaises(Error, msg= "Please set all arguments correctly."):
+            market.record_trade('TEA', 1, 'B', 100, nan)
+        self.assertEqual(len(market.stocks['TEA'].trade_records), 4)
+        self.assertEqual(market.rejection_counts()[ARGUMENTS_NOT_SET], 4)
+        
+    def test_infinity_is_rejected(self):
+        market = Market(shard_count = 4)
+        market.create_stock('TEA', 'C', 5, 100)
+        market.create_stock('GIN', 'P', 8, 100, 0.02)
+        inf = float('inf')
+        market.record_trade('GIN', 1, 'B', 50)
+        with self.assertRaises(Error, msg= "Stock price needs to be positive."):
+            market.record_trade('TEA', 1, 'B', inf)
+        self.assertEqual(market.try_record_trade('TEA', inf, 'B', 100), QUANTITY_NOT_POSITIVE)
+        self.assertEqual(market.record_trades([('TEA', 1, 'B', 100), ('TEA', 1, 'B', inf), ('GIN', inf, 'S', 50)]),
+                         [(1, "Stock price needs to be positive."), (2, "Quantity needs to be positive.")])
+        self.assertEqual(market.record_trade_columns('TEA', [1, 1], 'BB', [inf, 200]),
+                         [(0, "Stock price needs to be positive.")])
+        self.assertEqual(market.record_trade_columns('TEA', array('d', [inf, 1]), 'BB', array('d', [100, 200])),
+                         [(0, "Quantity needs to be positive.")])
+        self.assertEqual(len(market.stocks['TEA'].trade_records), 3)
+        self.assertAlmostEqual(market.gbce_all_share_index(), gmean([200, 50]))
+        
+        # sum which is not finite any more is computed again with the next update
+        market.stocks.shard('TEA').index.log_sum = inf
+        market.record_trade('TEA', 1, 'B', 100)
+        self.assertAlmostEqual(market.gbce_all_share_index(), gmean([100, 50]))
+        
+    def test_error_log(self):
+        error_log.enable(per_second = 3)
+        try:
+            with self.assertLogs('stock_market') as logs:
+                for _ in range(10):
+                    with self.assertRaises(Error):
+                        pe_ratio('COF', 100)
+        finally:
+            error_log.disable()
+        # at most 3 messages in a second, the count of the rest is logged in the next one
+        self.assertTrue(3 <= len(logs.output) <= 8)
+        self.assertEqual(logs.output[0], 'WARNING:stock_market:Stock COF is not yet created.')
+        
+        
+class MetricsTest(unittest.TestCase):
+    def test_latency_histogram(self):
+        histogram = LatencyHistogram()
+        self.assertEqual(histogram.quantile(0.5), 0)
+        for value in range(1, 100001):
+            histogram.record(value)
+        self.assertEqual((histogram.count, histogram.max), (100000, 100000))
+        for quantile in (0.5, 0.9, 0.99):
+            self.assertAlmostEqual(histogram.quantile(quantile) / (quantile * 100000), 1, delta = 1 / 16)
+        self.assertEqual(histogram.quantile(1), 100000)
+        histogram.record(1 << 50)
+        self.assertEqual(histogram.counts[-1], 1)
+        # every value goes to the bucket which starts at or below it
+        for value in (0, 31, 32, 33, 1000, 123456789):
+            self.assertTrue(LatencyHistogram.lowest_value(LatencyHistogram.bucket(value)) <= value < 
+                            LatencyHistogram.lowest_value(LatencyHistogram.bucket(value) + 1))
+        
+    def test_metrics(self):
+        market = Market(shard_count = 4)
+        metrics = Metrics(market)
+        market.create_stock('TEA', 'C', 5, 100)
+        metrics.enable()
+        market.create_stock('GIN', 'C', 5, 100)
+        market.record_trade('TEA', 5, 'B', 135)
+        market.record_trade('TEA', 5, 'B', 130)
+        market.try_record_trade('COF', 5, 'B', 135)
+        with self.assertRaises(Error):
+            market.record_trade('TEA', 5, 'X', 135)
+        market.volume_weighted_stock_price('TEA')
+        metrics.disable()
+        # not counted any more, and the market runs its own functions again
+        market.gbce_all_share_index()
+        self.assertEqual(market.record_trade, Market.record_trade.__get__(market))
+        
+        snapshot = metrics.snapshot()
+        self.assertTrue('stock_market_calls_total{function="create_stock"} 1\n' in snapshot)
+        self.assertTrue('stock_market_calls_total{function="record_trade"} 3\n' in snapshot)
+        self.assertTrue('stock_market_calls_total{function="try_record_trade"} 1\n' in snapshot)
+        self.assertTrue('stock_market_errors_total{function="record_trade"} 1\n' in snapshot)
+        self.assertTrue('stock_market_calls_total{function="gbce_all_share_index"} 0\n' in snapshot)
+        self.assertTrue('stock_market_latency_ns_count{function="volume_weighted_stock_price"} 1\n' in snapshot)
+        self.assertTrue('stock_market_trades{stock="TEA"} 2\nstock_market_trades{stock="GIN"} 0\n' in snapshot
+                        or 'stock_market_trades{stock="GIN"} 0\nstock_market_trades{stock="TEA"} 2\n' in snapshot)
+        self.assertTrue('stock_market_rejections_total{reason="stock_not_created"} 1\n' in snapshot)
+        self.assertTrue('stock_market_rejections_total{reason="side_not_set"} 1\n' in snapshot)
+        
+        server = metrics.serve(port = 0)
+        try:
+            with urllib.request.urlopen('http://127.0.0.1:%d/metrics' % server.server_address[1]) as response:
+                self.assertEqual(response.read().decode('utf-8'), metrics.snapshot())
+        finally:
+            server.shutdown()
+            server.server_close()
+        
+        
+class OrderBookTest(unittest.TestCase):
+    def setUp(self):
+        self.market = Market(shard_count = 4, clock = SimulatedClock())
+        self.market.create_stock('TEA', 'C', 5, 100)
+        self.engine = MatchingEngine(self.market)
+        
+    def test_limit_orders(self):
+        engine = self.engine
+        first = engine.limit_order('TEA', 'S', 10, 101)
+        second = engine.limit_order('TEA', 'S', 5, 101)
+        engine.limit_order('TEA', 'S', 20, 102)
+        engine.limit_order('TEA', 'B', 7, 99)
+        self.assertEqual((engine.best_bid('TEA'), engine.best_ask('TEA')), (99, 101))
+        self.assertEqual(engine.book('TEA').depth(), ([(99, 7)], [(101, 15), (102, 20)]))
+        self.assertEqual(self.market.stocks['TEA'].trade_records, [])
+        
+        # oldest order at the best price is filled first, trades are at its price
+        third = engine.limit_order('TEA', 'B', 12, 101)
+        self.assertEqual(engine.remaining_quantity(first), 0)
+        self.assertEqual(engine.remaining_quantity(second), 3)
+        self.assertEqual(engine.remaining_quantity(third), 0)
+        self.assertEqual(in_seconds(self.market.stocks['TEA'].trade_records), [(0, 10, 'B', 101), (0, 2, 'B', 101)])
+        
+        # rest of an order which crosses the book waits at its limit price
+        fourth = engine.limit_order('TEA', 'B', 30, 102)
+        self.assertEqual(engine.remaining_quantity(fourth), 7)
+        self.assertEqual(engine.book('TEA').depth(), ([(102, 7), (99, 7)], []))
+        self.assertEqual(self.market.volume_weighted_stock_price('TEA'), (12 * 101 + 3 * 101 + 20 * 102) / 35)
+        self.assertAlmostEqual(self.market.gbce_all_share_index(), 102)
+        
+    def test_market_orders_and_cancels(self):
+        engine = self.engine
+        orders = [engine.limit_order('TEA', 'B', 10, price) for price in (100, 99, 98)]
+        self.assertTrue(engine.cancel_order(orders[1]))
+        self.assertFalse(engine.cancel_order(orders[1]))
+        self.assertEqual(engine.book('TEA').depth(), ([(100, 10), (98, 10)], []))
+        
+        self.assertEqual(engine.market_order('TEA', 'S', 15), 15)
+        self.assertEqual(in_seconds(self.market.stocks['TEA'].trade_records), [(0, 10, 'S', 100), (0, 5, 'S', 98)])
+        # market order takes what there is, the rest is dropped
+        self.assertEqual(engine.market_order('TEA', 'S', 15), 5)
+        self.assertEqual(engine.market_order('TEA', 'S', 15), 0)
+        self.assertEqual(engine.best_bid('TEA'), None)
+        self.assertFalse(engine.cancel_order(orders[0]))
+        self.assertEqual(engine.orders, {})
+        
+        with self.assertRaises(Error, msg= "Stock COF is not yet created."):
+            engine.limit_order('COF', 'B', 10, 100)
+        with self.assertRaises(Error, msg= "Stock price needs to be positive."):
+            engine.limit_order('TEA', 'B', 10, 0)
+        with self.assertRaises(Error, msg= "Quantity needs to be positive."):
+            engine.market_order('TEA', 'B', -1)
+        with self.assertRaises(Error, msg= "Buy or sell indicator is not properly set."):
+            engine.market_order('TEA', 'X', 10)
+        with self.assertRaises(Error, msg= "Please set all arguments correctly."):
+            engine.limit_order('TEA', 'B', 10, 'A')
+        
+    def test_orders_which_cannot_trade(self):
+        engine = self.engine
+        nan, inf = float('nan'), float('inf')
+        with self.assertRaises(Error, msg= "Stock price needs to be positive."):
+            engine.limit_order('TEA', 'B', 10, nan)
+        with self.assertRaises(Error, msg= "Stock price needs to be positive."):
+            engine.limit_order('TEA', 'B', 10, inf)
+        with self.assertRaises(Error, msg= "Quantity needs to be positive."):
+            engine.market_order('TEA', 'S', nan)
+        self.assertEqual(engine.best_bid('TEA'), None)
+        
+        # fills which the market does not record are not executed
+        order = engine.limit_order('TEA', 'B', 10, 100)
+        # as if the stock was removed after the order was checked
+        self.market.try_record_trade = lambda *trade: STOCK_NOT_CREATED
+        self.assertEqual(engine.market_order('TEA', 'S', 5), 0)
+        del self.market.try_record_trade
+        self.assertEqual(engine.remaining_quantity(order), 10)
+        self.assertEqual(engine.market_order('TEA', 'S', 15), 10)
+        self.assertEqual(in_seconds(self.market.stocks['TEA'].trade_records), [(0, 10, 'S', 100)])
+        
+        
+class ClockTest(unittest.TestCase):
+    def test_system_clock(self):
+        clock = SystemClock()
+        self.assertEqual(clock.epoch_ns % NANOSECONDS, 0)
+        times = [clock.now() for _ in range(1000)]
+        self.assertEqual(times, sorted(times))
+        self.assertAlmostEqual(clock.time(), time.time(), places = 2)
+        self.assertEqual(clock.timestamp(clock.epoch_ns // NANOSECONDS + 1.5), 1500000000)
+        
+    def test_coarse_clock(self):
+        clock = CoarseClock()
+        market = Market(shard_count = 4, clock = clock)
+        market.create_stock('TEA', 'C', 5, 100)
+        market.create_stock('GIN', 'C', 5, 100)
+        market.record_trade('TEA', 5, 'B', 135)
+        time.sleep(0.001)
+        market.record_trade('GIN', 5, 'B', 135)
+        # not refreshed between single trades, and all stocks share the epoch
+        self.assertEqual(market.stocks['TEA'].trade_records[0][0], market.stocks['GIN'].trade_records[0][0])
+        
+        # refreshed for every batch
+        market.record_trades([('TEA', 15, 'S', 120)])
+        self.assertTrue(market.stocks['TEA'].trade_records[1][0] > market.stocks['TEA'].trade_records[0][0])
+        
+    def test_simulated_clock(self):
+        clock = SimulatedClock(1000 * NANOSECONDS)
+        market = Market(shard_count = 4, clock = clock)
+        market.create_stock('TEA', 'C', 5, 100)
+        clock.set(1010.25)
+        market.record_trade('TEA', 5, 'B', 135)
+        clock.advance(61)
+        market.record_trade('TEA', 15, 'S', 120, 0.5)
+        self.assertEqual(list(market.stocks['TEA'].trade_records.timestamps), [10250000000, 70750000000])
+        self.assertEqual(clock.time(), 1071.25)
+        self.assertEqual(market.volume_weighted_stock_price('TEA', 1), 120)
+        self.assertEqual(market.volume_weighted_stock_price_between('TEA', 1010.25, 1070.75), (5*135 + 15*120)/20)
+        
+        
+class ShardedEngineTest(unittest.TestCase):
+    def test_sharded_engine(self):
+        with ShardedEngine(process_count = 3, batch_size = 2) as engine:
+            self.assertEqual(engine.create_stock('TEA', 'C', 5, 100), None)
+            self.assertEqual(engine.create_stock('GIN', 'P', 8, 100, 0.02), None)
+            self.assertEqual(engine.create_stock('POP', 'C', 8, 100), None)
+            
+            with self.assertRaises(Error, msg= "Stock TEA is already created."):
+                engine.create_stock('TEA', 'C', 0, 100)
+            
+            with self.assertRaises(Error, msg= "There are no trade records."):
+                engine.gbce_all_share_index()
+            
+            self.assertEqual(engine.record_trade('TEA', 5, 'B', 135, 1000), None)
+            self.assertEqual(engine.record_trade('TEA', 15, 'S', 120, 100), None)
+            self.assertEqual(engine.record_trade('GIN', 20, 'S', 56, 500), None)
+            self.assertEqual(engine.record_trade('POP', 18, 'B', 130), None)
+            self.assertEqual(engine.record_trade('COF', 18, 'B', 130), None)
+            self.assertEqual(engine.record_trades([('GIN', 10, 'B', 70, -2), ('TEA', 0, 'B', 10)]), None)
+            
+            self.assertEqual(engine.volume_weighted_stock_price('TEA'), 120)
+            self.assertEqual(engine.volume_weighted_stock_price('GIN'), (20*56 + 10*70)/(20+10))
+            self.assertEqual(engine.dividend_yield('GIN', 150), 0.02*100/150)
+            self.assertAlmostEqual(engine.gbce_all_share_index(), gmean([120, 70, 130]))
+            
+            if numpy is not None:
+                self.assertEqual(list(engine.dividend_yields(['GIN', 'POP', 'TEA'], [150, 100, 120])),
+                                 [0.02*100/150, 8/100, 5/120])
+            
+            engine.flush()
+            self.assertEqual(sorted(engine.rejected), [(('COF', 18, 'B', 130), "Stock COF is not yet created."),
+                                                       (('TEA', 0, 'B', 10), "Quantity needs to be positive.")])
+            
+            # row which gives no timestamp is rejected alone, the rest of its batch is recorded
+            engine.record_trades([('POP', 1, 'B', 100, float('inf')), ('POP', 2, 'S', 100)])
+            engine.flush()
+            self.assertEqual(engine.rejected[2:], [(('POP', 1, 'B', 100), "Please set all arguments correctly.")])
+            self.assertEqual(engine.ohlcv_bar('POP', 1)[4], 20)
+            
+    def test_rejected_batches(self):
+        # replies listing every row of a batch are bigger than the pipe, while further batches are sent
+        with ShardedEngine(1, 10000) as engine:
+            for _ in range(5):
+                engine.record_trades([('COF', 1, 'B', 100)] * 10000)
+            engine.flush()
+            self.assertEqual(len(engine.rejected), 50000)
+            self.assertEqual(engine.rejected[-1], (('COF', 1, 'B', 100), "Stock COF is not yet created."))
+        
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        descriptor, self.path = tempfile.mkstemp()
+        os.close(descriptor)
+        
+    def tearDown(self):
+        os.remove(self.path)
+        
+    def test_journal(self):
+        market = Market()
+        market.create_stock('TEA', 'C', 5, 100)
+        market.create_stock('GIN', 'P', 8, 100, 0.02)
+        market.journal = TradeJournal(self.path, group_size = 3)
+        
+        market.record_trade('TEA', 5, 'B', 135, 1000)
+        market.record_trade('TEA', 15, 'S', 120, 100)
+        market.record_trade('GIN', 20, 'S', 56, 500)
+        market.record_trades([('TEA', 18, 'B', 130), ('GIN', 10, 'B', 70, -2), ('GIN', 0, 'B', 70)])
+        market.record_trade_columns('TEA', [4], 'S', [125], [50])
+        market.journal.close()
+        
+        # market started later has a later epoch, journal moves trades to it
+        recovered = Market(clock = SystemClock(market.clock.epoch_ns + 7 * NANOSECONDS))
+        recovered.create_stock('TEA', 'C', 5, 100)
+        recovered.create_stock('GIN', 'P', 8, 100, 0.02)
+        
+        self.assertEqual(load_journal(self.path, recovered), (6, set()))
+        self.assertEqual([(timestamp + 7 * NANOSECONDS,) + tuple(record) 
+                          for timestamp, *record in recovered.stocks['TEA'].trade_records],
+                         market.stocks['TEA'].trade_records[:])
+        self.assertEqual([(timestamp + 7 * NANOSECONDS,) + tuple(record) 
+                          for timestamp, *record in recovered.stocks['GIN'].trade_records],
+                         market.stocks['GIN'].trade_records[:])
+        self.assertAlmostEqual(recovered.gbce_all_share_index(), market.gbce_all_share_index())
+        
+        recovered.remove_stock('GIN')
+        recovered.stocks.clear()
+        recovered.create_stock('TEA', 'C', 5, 100)
+        self.assertEqual(load_journal(self.path, recovered), (4, {'GIN'}))
+
+    def test_journal_written_after_interval(self):
+        market = Market()
+        market.create_stock('TEA', 'C', 5, 100)
+        market.journal = TradeJournal(self.path, fsync_interval = 0.05)
+        market.record_trade('TEA', 5, 'B', 135)
+        market.record_trades([('TEA', 15, 'S', 120)])
+        market.record_trade_columns('TEA', [4], 'S', [125])
+        # far fewer trades than group_size, no more trades come and nothing calls commit()
+        deadline = time.monotonic() + 5
+        while market.journal.pending_count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        
+        recovered = Market(clock = SystemClock(market.clock.epoch_ns))
+        recovered.create_stock('TEA', 'C', 5, 100)
+        self.assertEqual(load_journal(self.path, recovered), (3, set()))
+        market.journal.close()
+        self.assertFalse(market.journal.flusher.is_alive())
+        
+    def test_incomplete_block(self):
+        market = Market()
+        market.create_stock('TEA', 'C', 5, 100)
+        market.journal = TradeJournal(self.path)
+        market.record_trade('TEA', 5, 'B', 135)
+        market.journal.close()
+        
+        # crash while writing the second block
+        with open(self.path, 'ab') as file:
+            file.write(b'TEA' + bytes(40))
+            
+        market.journal = TradeJournal(self.path)
+        market.record_trade('TEA', 15, 'S', 120)
+        market.journal.close()
+        
+        recovered = Market(clock = SystemClock(market.clock.epoch_ns))
+        recovered.create_stock('TEA', 'C', 5, 100)
+        self.assertEqual(load_journal(self.path, recovered), (2, set()))
+        self.assertEqual(recovered.stocks['TEA'].trade_records[:], market.stocks['TEA'].trade_records[:])
+        
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'trades.csv')
+        # one trade of TEA every 10 seconds for 3 minutes, GIN trades only in the first minute
+        self.rows = [(1000000 + 10 * number, 'TEA', 1 + number % 3, 'B', 100 + number) for number in range(18)]
+        self.rows += [(1000005 + 10 * number, 'GIN', 2, 'S', 50) for number in range(6)]
+        self.rows.append((1000030, 'COF', 1, 'B', 10))
+        self.rows.sort()
+        with open(self.path, 'w') as file:
+            file.write('stock_price,timestamp,stock_name,quantity,buy_sell_ind\n')
+            for timestamp, stock_name, quantity, buy_sell_ind, stock_price in self.rows:
+                file.write('%s,%s,%s,%s,%s\n' % (stock_price, timestamp, stock_name, quantity, buy_sell_ind))
+        
+    def tearDown(self):
+        self.directory.cleanup()
+        
+    def check_snapshots(self, chunks, rejected = 1):
+        market = Market(shard_count = 4)
+        market.create_stock('TEA', 'C', 5, 100)
+        market.create_stock('GIN', 'P', 8, 100, 0.02)
+        real_clock = market.clock
+        snapshots = list(replay(market, chunks, interval = 60))
+        
+        self.assertEqual([snapshot.time for snapshot in snapshots], [1000060, 1000120, 1000180])
+        self.assertEqual([(snapshot.recorded, snapshot.rejected) for snapshot in snapshots], 
+                         [(12, rejected), (18, rejected), (24, rejected)])
+        tea = [(1 + number % 3, 100 + number) for number in range(18)]
+        self.assertEqual(snapshots[0].prices, {'TEA': sum(q * p for q, p in tea[:6]) / sum(q for q, _ in tea[:6]),
+                                               'GIN': 50})
+        self.assertEqual(snapshots[2].prices['TEA'], sum(q * p for q, p in tea) / sum(q for q, _ in tea))
+        self.assertAlmostEqual(snapshots[2].index, gmean([117, 50]))
+        # market is back on real time
+        self.assertTrue(market.clock is real_clock)
+        
+    def test_replay_csv(self):
+        self.check_snapshots(read_csv(self.path, chunk_size = 7))
+        
+    def test_replay_journal(self):
+        market = Market(shard_count = 4)
+        market.create_stock('TEA', 'C', 5, 100)
+        market.create_stock('GIN', 'P', 8, 100, 0.02)
+        journal_path = os.path.join(self.directory.name, 'journal')
+        market.journal = TradeJournal(journal_path, group_size = 5)
+        market.clock = SimulatedClock(market.clock.epoch_ns)
+        for timestamp, stock_name, quantity, buy_sell_ind, stock_price in self.rows:
+            if stock_name != 'COF':
+                market.clock.set(timestamp)
+                market.record_trade(stock_name, quantity, buy_sell_ind, stock_price)
+        market.journal.close()
+        
+        chunks = list(read_journal_trades(journal_path, chunk_size = 10))
+        self.assertEqual(sum(len(chunk[0]) for chunk in chunks), 24)
+        # first group commit has blocks of TEA and GIN, with timestamps in seconds since the epoch
+        self.assertEqual(sorted(zip(*chunks[0][:2]))[:5], [(1000000, 'TEA'), (1000005, 'GIN'), (1000010, 'TEA'),
+                                                           (1000015, 'GIN'), (1000020, 'TEA')])
+        self.check_snapshots(chunks, rejected = 0)
+        
+    @unittest.skipUnless(pyarrow, "pyarrow is not installed")
+    def test_replay_parquet(self):
+        import pyarrow.parquet
+        path = os.path.join(self.directory.name, 'trades.parquet')
+        table = pyarrow.table({column: [row[number] for row in self.rows] 
+                               for number, column in enumerate(['timestamp', 'stock_name', 'quantity', 
+                                                                'buy_sell_ind', 'stock_price'])})
+        pyarrow.parquet.write_table(table, path)
+        self.check_snapshots(read_parquet(path, chunk_size = 7))
+        
+        
+class ServerTest(unittest.TestCase):
+    def test_server(self):
+        market = Market()
         
-        self.assertEqual(stocks['POP'].trade_records, [(0, 18, 'B', 130)])
+        async def session():
+            server = await start_server(market, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            # all requests are sent before reading any response
+            writer.write(b'C TEA C 5 100\nC GIN P 8 100 0.02\nT TEA 15 S 120\nT TEA 18 B 130\n'
+                         b'T GIN 20 S 56\nVWSP TEA\nDY GIN 150\nPE TEA 80\nGBCE\n'
+                         b'T COF 5 B 10\nT TEA B S 120\nXYZ\nBAR TEA 1\n')
+            await writer.drain()
+            responses = [await reader.readline() for _ in range(13)]
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            return responses
         
-        self.assertEqual(gbce_all_share_index(), gmean([120, 70,130]))
+        responses = asyncio.run(session())
+        self.assertEqual(responses[:5], [b'OK\n'] * 5)
+        self.assertEqual(responses[5], b'OK %r\n' % ((15*120 + 18*130)/(15+18)))
+        self.assertEqual(responses[6], b'OK %r\n' % (0.02*100/150))
+        self.assertEqual(responses[7], b'OK %r\n' % (80/5))
+        self.assertAlmostEqual(float(responses[8].split()[1]), gmean([130, 56]))
+        self.assertEqual(responses[9:], [b'ERR Stock COF is not yet created.\n',
+                                         b'ERR Please set all arguments correctly.\n',
+                                         b'ERR Unknown command.\n',
+                                         b'OK (120.0, 130.0, 120.0, 130.0, 33.0)\n'])
         
-        stocks.clear()        
 
 if __name__ == '__main__':
     unittest.main()